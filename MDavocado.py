@@ -1,17 +1,171 @@
 #!/usr/bin/env python3
-from ramachandran import *
+"""
+Makes the MDavocado plots of a trajectory.
+
+    ./MDavocado.py topology.file trajectory.file [options]
+
+The work is done in stages: extract (the angles of all frames to
+rama_all.json or janin_all.json), render (histograms, images, gifs and
+montages), correlations and ruptures (change points). By default the angles
+are extracted and rendered. Rendering alone starts from the angles saved by an
+earlier extraction, without reading the trajectory again. With --plots both
+and --engine numpy the Ramachandran and Janin angles are extracted together,
+in one pass over the trajectory. See --help for all
+the options. The heavy modules are imported only by the stages which need them.
+"""
+import os
 import sys
+import argparse
 
-def guacamole(topology,trajectory):
+STAGES = ['extract', 'render', 'correlations', 'ruptures']
+TABLES = {'rama': 'rama_all.json', 'janin': 'janin_all.json'} # Saved angles of the plots
+
+def guacamole(topology,trajectory,workers=1,stride=1,progressive=0):
     """
     The main wrapper function that initialises the RamachandranPlots class
     from the MDAnalysis Universe and makes all MDavocado plots for the given trajectory.
+    With workers > 1 the angles are extracted in parallel by that many processes.
+    stride > 1 uses only every stride-th frame and progressive=k makes quick
+    previews from every k-th of those first, which are then refined in place.
     """
+    from ramachandran import Universe, RamachandranPlots
     u = Universe(topology,trajectory)
-    rp = RamachandranPlots(u)
-    rp.run()
+    rp = RamachandranPlots(u,workers=workers)
+    rp.run(stride=stride,progressive=progressive)
+
+def make_plots(kind, universe, args):
+    "RamachandranPlots (kind 'rama') or JaninPlots (kind 'janin') set up from the options args"
+    from ramachandran import RamachandranPlots, JaninPlots
+    Plots = {'rama': RamachandranPlots, 'janin': JaninPlots}[kind]
+    plots = Plots(universe, workers=args.workers, engine=args.engine, directory=args.output,
+                  selection=args.selection, start=args.start, stop=args.stop)
+    return configure(plots, args)
+
+def configure(plots, args):
+    "Sets the slices and outputs of plots from the options args"
+    plots.n = args.n
+    plots.formats = args.formats
+    plots.sprite_size = args.sprite_size
+    return plots
+
+def extract_both(universe, args):
+    """RamachandranPlots and JaninPlots (by kind) with the angles of both
+    extracted together, reading the trajectory only once (numpy engine only)
+    """
+    from ramachandran import extract_rama_and_janin
+    rp, jp = extract_rama_and_janin(universe, workers=args.workers, directory=args.output,
+                                    selection=args.selection, start=args.start, stop=args.stop,
+                                    n=args.n, resume=not args.no_resume)
+    return {'rama': configure(rp, args), 'janin': configure(jp, args)}
+
+def load_table(plots, kind, args):
+    "Reads the angles saved by the extract stage (or given by --table) into plots"
+    path = args.table or os.path.join(plots.dir, TABLES[kind])
+    if not os.path.exists(path):
+        sys.exit("No angles saved in %s, run the extract stage first" % path)
+    getattr(plots, 'read_' + kind)(path)
+    rows = len(getattr(plots, kind))
+    if rows != plots.nframes:
+        sys.exit("%s has %d frames, the trajectory (with --start/--stop) %d" % (path, rows, plots.nframes))
+
+def extract_and_render(plots, kind, args):
+    "The extract and render stages of plots, the extraction skipped if extract_both did it"
+    resume = not args.no_resume
+    if 'render' not in args.stages:
+        if getattr(plots, kind) is not None:
+            return
+        plots.open_manifest(resume)
+        plots.open_report(args.profile)
+        with plots.report.stage('make_all_dataframes'):
+            plots.make_all_dataframes()
+        plots.concat_dataframes()
+        return
+    if 'extract' not in args.stages:
+        load_table(plots, kind, args)
+    if kind == 'rama':
+        plots.run(stream=args.stream, chunk=args.chunk, keep_angles=args.keep_angles, resume=resume,
+                  stride=args.stride, progressive=args.progressive, profile=args.profile)
+    else:
+        plots.run(resume=resume, profile=args.profile)
+
+def correlations(plots, kind, args):
+    "Circular correlations of all the angles, and in every window of --window slices"
+    if getattr(plots, kind) is None:
+        load_table(plots, kind, args)
+    plots.circular_correlation_matrix(chunk=args.chunk)
+    plots.truncate_correlation_matrix(args.limit)
+    plots.extract_correlations(args.limit)
+    if args.window:
+        plots.sliding_correlations(args.window, args.limit, chunk=args.chunk)
+
+def ruptures(directory, args):
+    "Change points of the Ramachandran angles saved in directory"
+    from batch import load_ruptures # ruptures.py has the name of the library it uses
+    load_ruptures().do_ruptures(directory, workers=args.workers, plot=not args.no_plots, mode=args.mode)
+
+def parser():
+    p = argparse.ArgumentParser(description='MD Analysis and Visualization Of Correlated Angular Diagrams')
+    p.add_argument('topology')
+    p.add_argument('trajectory')
+    p.add_argument('-n', type=int, default=10, help='Number of slices to cut the trajectory into (default 10)')
+    p.add_argument('--selection', default='protein', help="Atoms of the protein (default 'protein')")
+    p.add_argument('--plots', default='rama', choices=['rama', 'janin', 'both'],
+                   help='Ramachandran (phi/psi), Janin (chi1/chi2) or both (default rama)')
+    p.add_argument('--stages', nargs='+', default=['extract', 'render'], choices=STAGES,
+                   help='Stages to run (default extract render)')
+    p.add_argument('--workers', type=int, default=1, help='Number of processes (default 1)')
+    p.add_argument('--engine', default='mdanalysis', choices=['mdanalysis', 'numpy'],
+                   help='MDAnalysis dihedral analysis or the vectorized numpy kernel')
+    p.add_argument('--chunk', type=int, default=10000, help='Frames held in memory at once (default 10000)')
+    p.add_argument('--formats', nargs='+', default=['gif'], choices=['gif', 'webp', 'apng', 'sprites'],
+                   help='Animations of every residue and chain, and/or one sprite sheet per chain (default gif)')
+    p.add_argument('--sprite-size', type=int, default=100, help='Tiles of the sprite sheets in pixels (default 100)')
+    p.add_argument('--start', type=int, default=0, help='First frame used')
+    p.add_argument('--stop', type=int, help='Frame after the last one used')
+    p.add_argument('--stride', type=int, default=1, help='Use only every stride-th frame (rama render only)')
+    p.add_argument('--progressive', type=int, default=0,
+                   help='Make previews from every k-th frame first, then refine them (rama render only)')
+    p.add_argument('--stream', action='store_true', help='Bin the angles chunk by chunk (rama render only)')
+    p.add_argument('--keep-angles', action='store_true', help='Save the angles while streaming')
+    p.add_argument('-o', '--output', help='Output directory (default: directory of the topology)')
+    p.add_argument('--table', help='Saved angles to render from (default: the ones in the output directory)')
+    p.add_argument('--limit', type=float, default=0.5, help='Smallest |r| of the correlations kept (default 0.5)')
+    p.add_argument('--window', type=int, default=0, help='Also correlations in windows of this many slices')
+    p.add_argument('--mode', default='legacy', choices=['legacy', 'unwrap', 'centered'],
+                   help='How ruptures removes the spikes of the angles (default legacy)')
+    p.add_argument('--no-plots', action='store_true', help='Change points without the figures')
+    p.add_argument('--no-resume', action='store_true', help='Do everything again, ignoring the manifest')
+    p.add_argument('--profile', action='store_true', help='Save cProfile statistics of every stage to profiles/')
+    return p
+
+def main(argv=None):
+    p = parser()
+    args = p.parse_args(argv)
+    kinds = ['rama', 'janin'] if args.plots == 'both' else [args.plots]
+    if 'janin' in kinds and (args.stride > 1 or args.progressive > 1 or args.stream):
+        p.error('--stride, --progressive and --stream are only for Ramachandran plots')
+    if 'ruptures' in args.stages and 'rama' not in kinds:
+        p.error('ruptures needs the Ramachandran angles, use --plots rama or both')
+    if args.table and len(kinds) > 1:
+        p.error('--table needs --plots rama or janin')
+    # Absolute, as the worker processes open them again
+    args.topology, args.trajectory = os.path.abspath(args.topology), os.path.abspath(args.trajectory)
+    directory = os.path.abspath(args.output or os.path.dirname(args.topology))
+    args.output = directory
+    if set(args.stages) - {'ruptures'}:
+        from ramachandran import Universe
+        u = Universe(args.topology, args.trajectory)
+        if 'extract' in args.stages and len(kinds) > 1 and args.engine == 'numpy':
+            plots = extract_both(u, args)
+        else:
+            plots = {kind: make_plots(kind, u, args) for kind in kinds}
+        for kind in kinds:
+            if {'extract', 'render'} & set(args.stages):
+                extract_and_render(plots[kind], kind, args)
+            if 'correlations' in args.stages:
+                correlations(plots[kind], kind, args)
+    if 'ruptures' in args.stages:
+        ruptures(directory, args)
 
 if __name__ == "__main__":
-    #TODO make this much nicer and friendlier with argparse library
-    topology, trajectory = sys.argv[1], sys.argv[2]
-    guacamole(topology,trajectory)
+    main()
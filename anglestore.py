@@ -0,0 +1,149 @@
+"""
+Columnar store for the tables of angles.
+
+A table (frames as rows, two angles per residue as columns) is kept as a raw
+float32 binary file name.f32 together with a small JSON header name.json
+describing the frames, the residues and the column layout. The binary file is
+opened as a numpy memmap, so extraction workers can write directly into their
+own rows and the analysis can read it without loading (or copying) it into RAM.
+"""
+import os
+import json
+import numpy as np
+import pandas as pd
+
+def store_paths(path):
+    "Header and data file names for a store given by either of them or by their common stem"
+    stem = os.path.splitext(path)[0] if path.endswith(('.json','.f32')) else path
+    return stem + '.json', stem + '.f32'
+
+class AngleStore:
+    """
+    Table of angles in degrees (nframes, 2*nresidues) memory mapped from disk.
+    Columns 2*i and 2*i+1 are the two angles (phi/psi or chi1/chi2)
+    of the i-th residue in the header.
+    """
+
+    def __init__(self, path, mode='r'):
+        "Opens an existing store, mode 'r' for reading or 'r+' for writing"
+        self.header_path, self.data_path = store_paths(path)
+        with open(self.header_path) as f:
+            self.header = json.load(f)
+        self.shape = tuple(self.header['shape'])
+        self.array = np.memmap(self.data_path, dtype=self.header['dtype'], mode=mode, shape=self.shape)
+
+    @classmethod
+    def create(cls, path, nframes, residues, columns, kind, frames=None, chains=None):
+        """Preallocates a store for nframes frames.
+        residues is a list of (segid, resid, resname), columns the names
+        of the two angles of each residue e.g. ('phi','psi'), chains a list of
+        (chain name, number in the chain, serial number) of the residues (see ResidueIndex).
+        """
+        header_path, data_path = store_paths(path)
+        header = {'kind': kind,
+                  'dtype': 'float32',
+                  'shape': [nframes, 2*len(residues)],
+                  'frames': frames or {'start': 0, 'stop': nframes, 'step': 1},
+                  'columns': list(columns),
+                  'residues': [list(r) for r in residues]}
+        if chains is not None:
+            header['chains'] = [list(c) for c in chains]
+        with open(header_path, 'w') as f:
+            json.dump(header, f)
+        np.memmap(data_path, dtype='float32', mode='w+', shape=tuple(header['shape'])).flush()
+        return cls(path, mode='r+')
+
+    def write(self, start, angles):
+        "Writes angles (nframes, nresidues, 2) or (nframes, 2*nresidues) to rows from start on"
+        angles = np.asarray(angles).reshape(len(angles), -1)
+        self.array[start:start+len(angles)] = angles
+        self.array.flush()
+
+    def grow(self, nframes):
+        """Extends the store in place to nframes rows (e.g. for frames appended
+        to the trajectory) and returns it opened again for writing.
+        """
+        self.array.flush()
+        del self.array
+        frames = self.header['frames']
+        frames['stop'] = frames['start'] + nframes*frames['step']
+        self.header['shape'][0] = nframes
+        os.truncate(self.data_path, nframes*self.shape[1]*np.dtype(self.header['dtype']).itemsize)
+        with open(self.header_path, 'w') as f:
+            json.dump(self.header, f)
+        return AngleStore(self.header_path, mode='r+')
+
+    def dataframe(self):
+        "The whole table as a DataFrame backed by the memmap (no copy is made)"
+        return pd.DataFrame(self.array, copy=False)
+
+def write_angles(path, start, angles):
+    "Writes angles into rows from start on of the store at path (used by worker processes)"
+    AngleStore(path, mode='r+').write(start, angles)
+
+def open_angles(file):
+    """Table of angles from either an AngleStore (.json/.f32)
+    or from a pickled DataFrame (.pkl) written by older versions.
+    """
+    if file.endswith('.pkl'):
+        return pd.read_pickle(file)
+    return AngleStore(file).dataframe()
+
+def circular_means(table, chunk=10000):
+    "Circular mean in degrees of every column of the table, read chunk frames at a time"
+    s, c = np.zeros(table.shape[1]), np.zeros(table.shape[1])
+    for i in range(0, len(table), chunk):
+        x = np.radians(np.asarray(table[i:i+chunk], dtype=np.float64))
+        s += np.sin(x).sum(axis=0)
+        c += np.cos(x).sum(axis=0)
+    return np.degrees(np.arctan2(s, c))
+
+def unwrap_angles(source, target=None, mode='unwrap', chunk=10000):
+    """Removes the spikes of the angles (nframes, ncolumns) in degrees of source,
+    i.e. the jumps by 360 when an angle crosses +-180, and writes them to target
+    (in place into source if target is None), chunk frames at a time.
+    Like np.unwrap the last angle and the number of turns of every column are
+    carried from one chunk to the next, so only about one chunk is in memory.
+    mode is one of
+      'unwrap'   continuous angles, which can go beyond +-180 (and +-360)
+      'legacy'   the same cut with fmod to (-360, 360), as the old remove_spikes did
+      'centered' no unwrapping, each angle wrapped into the circle of +-180
+                 around the circular mean of its column, so angles staying on
+                 one side of +-180 have no spikes and no drift
+    """
+    target = source if target is None else target
+    if mode not in ('unwrap', 'legacy', 'centered'):
+        raise ValueError("Unknown mode %r, use 'unwrap', 'legacy' or 'centered'" % mode)
+    if mode == 'centered':
+        mean = circular_means(source, chunk)
+    last, turns = None, np.zeros(source.shape[1])
+    for i in range(0, len(source), chunk):
+        x = np.asarray(source[i:i+chunk], dtype=np.float64)
+        if mode == 'centered':
+            target[i:i+chunk] = mean + (x - mean + 180) % 360 - 180
+            continue
+        d = np.diff(x, axis=0, prepend=x[:1] if last is None else last[None])
+        steps = turns + np.cumsum((d < -180).astype(int) - (d > 180), axis=0)
+        last, turns = x[-1].copy(), steps[-1]
+        y = x + 360*steps # A new array, x may be a view of source
+        target[i:i+chunk] = np.fmod(y, 360) if mode == 'legacy' else y
+    if hasattr(target, 'flush'):
+        target.flush()
+    return target
+
+def unwrap_store(path, target=None, mode='unwrap', chunk=10000):
+    """Unwraps the angles of the AngleStore at path (see unwrap_angles) into
+    a new store target with the same header, or in place if target is None
+    """
+    source = AngleStore(path, mode='r' if target else 'r+')
+    if target is None:
+        store = source
+    else:
+        header = dict(source.header)
+        store = AngleStore.create(target, source.shape[0], header['residues'], header['columns'],
+                                  header['kind'], header['frames'], header.get('chains'))
+    store.header['unwrap'] = mode
+    with open(store.header_path, 'w') as f:
+        json.dump(store.header, f)
+    unwrap_angles(source.array, store.array, mode, chunk)
+    return store
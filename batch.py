@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+Batch runs of MDavocado over many trajectories (e.g. replicas).
+
+A manifest (JSON) lists the trajectories:
+
+    [{"name": "rep1", "topology": "rep1/protein.psf", "trajectory": "rep1/md.dcd"},
+     {"name": "rep2", "topology": "rep1/protein.psf", "trajectory": "rep2/md.dcd", "dir": "rep2"}]
+
+Relative paths are taken from the directory of the manifest. All files of a
+trajectory are written to its "dir" (by default the directory of the
+trajectory), which has to be different for every trajectory. The render stage
+makes the Ramachandran and the Janin plots there, with the chains animated as
+A.gif ... and janin_A.gif ... respectively.
+
+Every trajectory goes through the stages extract, then render, correlate and
+ruptures (which only need the extracted angles). The stages of all the
+trajectories share one pool of workers processes: a stage is started as soon
+as a worker is free and its trajectory is extracted, so the cores stay busy
+across trajectories instead of idling at the end of one. Each job runs in a
+fresh process with its own resource limits and log file, gets only explicit
+paths (it never depends on the working directory) and is retried if it fails.
+A summary of all jobs is printed and saved as a JSON report.
+"""
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import traceback
+import multiprocessing as mp
+from multiprocessing.connection import wait
+
+STAGES = {'extract': (), # Stage: stages it needs
+          'render': ('extract',),
+          'correlate': ('extract',),
+          'ruptures': ('extract',)}
+
+def load_manifest(path):
+    "Trajectories listed in the manifest at path, with absolute paths"
+    top = os.path.dirname(os.path.abspath(path))
+    with open(path) as f:
+        entries = json.load(f)
+    trajectories = []
+    for i, entry in enumerate(entries):
+        t = dict(entry)
+        t['topology'] = os.path.join(top, t['topology'])
+        t['trajectory'] = os.path.join(top, t['trajectory'])
+        t['dir'] = os.path.join(top, t['dir']) if 'dir' in t else os.path.dirname(t['trajectory'])
+        t.setdefault('name', os.path.basename(t['dir']) or str(i))
+        trajectories.append(t)
+    dirs = [t['dir'] for t in trajectories]
+    if len(set(dirs)) < len(dirs):
+        raise ValueError("Every trajectory needs its own dir, give them in the manifest")
+    names = [t['name'] for t in trajectories]
+    if len(set(names)) < len(names):
+        raise ValueError("Names of the trajectories are not unique")
+    return trajectories
+
+def set_limits(limits):
+    """Applies the resource limits of a job to the current process:
+    memory (bytes of address space) and cpu (seconds of CPU time)
+    """
+    if limits.get('memory'):
+        resource.setrlimit(resource.RLIMIT_AS, (limits['memory'], limits['memory']))
+    if limits.get('cpu'):
+        resource.setrlimit(resource.RLIMIT_CPU, (limits['cpu'], limits['cpu']))
+
+def load_ruptures():
+    """ruptures.py of this directory, which has the same name as the ruptures
+    library it uses: the library is imported first from the rest of the path,
+    then this module under the name ruptureplots
+    """
+    import importlib.util
+    here = os.path.dirname(os.path.abspath(__file__))
+    path = sys.path[:]
+    sys.modules.pop('ruptures', None)
+    sys.path[:] = [p for p in path if os.path.abspath(p or '.') != here]
+    try:
+        import ruptures
+    finally:
+        sys.path[:] = path
+    spec = importlib.util.spec_from_file_location('ruptureplots', os.path.join(here, 'ruptures.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['ruptureplots'] = module
+    spec.loader.exec_module(module)
+    return module
+
+def run_stage(stage, t, options):
+    "Runs stage on the trajectory t (a manifest entry), only with explicit paths"
+    from ramachandran import Universe, RamachandranPlots, JaninPlots, extract_rama_and_janin
+    d = t['dir']
+    u = Universe(t['topology'], t['trajectory'])
+    if stage == 'extract':
+        extract_rama_and_janin(u, directory=d, n=options.get('n', 10))
+    elif stage == 'render':
+        for Plots, store in ((RamachandranPlots, 'rama_all.json'), (JaninPlots, 'janin_all.json')):
+            plots = Plots(u, engine='numpy', directory=d)
+            plots.n = options.get('n', plots.n)
+            if Plots is RamachandranPlots:
+                plots.read_rama(os.path.join(d, store))
+            else:
+                plots.read_janin(os.path.join(d, store))
+            plots.run()
+    elif stage == 'correlate':
+        limit = options.get('limit', 0.5)
+        rp, jp = RamachandranPlots(u, engine='numpy', directory=d), JaninPlots(u, engine='numpy', directory=d)
+        rp.read_rama(os.path.join(d, 'rama_all.json'))
+        jp.read_janin(os.path.join(d, 'janin_all.json'))
+        for plots in (rp, jp):
+            plots.circular_correlation_matrix()
+            plots.truncate_correlation_matrix(limit)
+            plots.extract_correlations(limit)
+    elif stage == 'ruptures':
+        load_ruptures().do_ruptures(d, plot=options.get('plot', True))
+    else:
+        raise ValueError("Unknown stage %r, use one of %s" % (stage, ', '.join(STAGES)))
+
+def job(stage, t, options, limits, conn):
+    "Entry point of the process of one job, reports back through conn"
+    log = open(os.path.join(t['dir'], 'batch_%s.log' % stage), 'a')
+    sys.stdout = sys.stderr = log
+    try:
+        set_limits(limits)
+        run_stage(stage, t, options)
+        conn.send(None)
+    except BaseException:
+        traceback.print_exc()
+        conn.send(traceback.format_exc(limit=3))
+    finally:
+        log.flush()
+
+class BatchRunner:
+    """
+    Runs the stages of all the trajectories on a pool of workers processes,
+    retrying every failed job up to retries times.
+    limits are the per job resource limits (memory in bytes, cpu in seconds)
+    and timeout the wall clock time (in seconds) after which a job is killed.
+    """
+
+    def __init__(self, trajectories, stages=tuple(STAGES), workers=None, retries=1,
+                 limits=None, timeout=None, options=None):
+        self.trajectories = {t['name']: t for t in trajectories}
+        self.stages = [s for s in STAGES if s in stages]
+        self.workers = workers or os.cpu_count()
+        self.retries = retries
+        self.limits = limits or {}
+        self.timeout = timeout
+        self.options = options or {}
+        self.jobs = {(name, s): {'trajectory': name, 'stage': s, 'status': 'pending', 'attempts': 0,
+                                 'seconds': 0.0, 'error': None}
+                     for name in self.trajectories for s in self.stages}
+
+    def needs(self, key):
+        "Jobs which have to be done before the job key (only among the stages being run)"
+        name, stage = key
+        return [(name, s) for s in STAGES[stage] if (name, s) in self.jobs]
+
+    def ready(self):
+        "Pending jobs whose stages are done, extractions first as everything else waits for them"
+        keys = [k for k, j in self.jobs.items() if j['status'] == 'pending'
+                and all(self.jobs[n]['status'] == 'done' for n in self.needs(k))]
+        return sorted(keys, key=lambda k: self.stages.index(k[1]))
+
+    def skip_dependents(self, key):
+        "Marks the jobs which needed the failed job key as skipped"
+        for k in self.jobs:
+            if key in self.needs(k) and self.jobs[k]['status'] == 'pending':
+                self.jobs[k]['status'] = 'skipped'
+                self.skip_dependents(k)
+
+    def start(self, key):
+        t = self.trajectories[key[0]]
+        os.makedirs(t['dir'], exist_ok=True)
+        receive, send = mp.Pipe(duplex=False)
+        p = mp.Process(target=job, args=(key[1], t, self.options, self.limits, send), name='%s:%s' % key)
+        p.start()
+        send.close()
+        self.jobs[key]['status'] = 'running'
+        self.jobs[key]['attempts'] += 1
+        print('Started %s %s (attempt %d)' % (key[1], key[0], self.jobs[key]['attempts']))
+        return p, receive, time.time()
+
+    def finish(self, key, p, receive, started, killed=False):
+        j = self.jobs[key]
+        p.join()
+        j['seconds'] += time.time() - started
+        error = 'Killed after %s s' % self.timeout if killed else None
+        if not killed:
+            try:
+                error = receive.recv()
+            except EOFError: # Died without reporting, e.g. on a resource limit
+                error = 'Process died with exit code %s' % p.exitcode
+        receive.close()
+        j['error'] = error
+        if error is None:
+            j['status'] = 'done'
+        elif j['attempts'] <= self.retries:
+            j['status'] = 'pending'
+        else:
+            j['status'] = 'failed'
+            self.skip_dependents(key)
+        print('%s %s %s' % (key[1], key[0], 'done' if error is None else 'failed: %s' % error.strip().splitlines()[-1]))
+
+    def run(self):
+        "Runs all jobs and returns them with their status"
+        running = {}
+        while True:
+            for key in self.ready()[:self.workers - len(running)]:
+                running[key] = self.start(key)
+            if not running:
+                break
+            wait([r[0].sentinel for r in running.values()], timeout=1)
+            for key, (p, receive, started) in list(running.items()):
+                late = self.timeout and time.time() - started > self.timeout
+                if late and p.is_alive():
+                    p.kill()
+                if not p.is_alive():
+                    self.finish(key, p, receive, started, killed=bool(late))
+                    del running[key]
+        return self.jobs
+
+    def report(self, path=None):
+        "Prints a summary of all jobs and saves it with the details to path (JSON)"
+        jobs = list(self.jobs.values())
+        print('%-20s %-10s %-8s %8s %9s' % ('trajectory', 'stage', 'status', 'attempts', 'seconds'))
+        for j in jobs:
+            print('%-20s %-10s %-8s %8d %9.1f' % (j['trajectory'], j['stage'], j['status'], j['attempts'], j['seconds']))
+        counts = {s: sum(j['status'] == s for j in jobs) for s in ('done', 'failed', 'skipped')}
+        print('%(done)d done, %(failed)d failed, %(skipped)d skipped' % counts)
+        if path:
+            with open(path, 'w') as f:
+                json.dump({'summary': counts, 'jobs': jobs}, f, indent=1)
+        return counts
+
+def size(text):
+    "Bytes from e.g. 512M or 8G"
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30}
+    return int(float(text[:-1])*units[text[-1].upper()]) if text[-1].upper() in units else int(text)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Runs MDavocado on all trajectories listed in a manifest')
+    parser.add_argument('manifest', help='JSON list of {"name", "topology", "trajectory", "dir"}')
+    parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=list(STAGES))
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Jobs running at the same time')
+    parser.add_argument('--retries', type=int, default=1, help='Times a failed job is started again')
+    parser.add_argument('--memory', type=size, help='Address space limit of each job, e.g. 8G')
+    parser.add_argument('--cpu-time', type=int, help='CPU time limit of each job in seconds')
+    parser.add_argument('--timeout', type=float, help='Wall clock limit of each job in seconds')
+    parser.add_argument('--n', type=int, default=10, help='Number of slices of each trajectory')
+    parser.add_argument('--limit', type=float, default=0.5, help='Smallest |r| of the correlations kept')
+    parser.add_argument('--no-plots', action='store_true', help='Change points without the figures')
+    parser.add_argument('--report', default='batch_report.json')
+    args = parser.parse_args()
+    runner = BatchRunner(load_manifest(args.manifest), args.stages, args.workers, args.retries,
+                         {'memory': args.memory, 'cpu': args.cpu_time}, args.timeout,
+                         {'n': args.n, 'limit': args.limit, 'plot': not args.no_plots})
+    runner.run()
+    counts = runner.report(args.report)
+    sys.exit(1 if counts['failed'] else 0)
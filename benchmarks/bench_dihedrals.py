@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Compares the vectorized DihedralKernel with MDAnalysis Ramachandran and Janin
+analysis: checks that the angles agree and reports the time each one takes.
+
+    ./benchmarks/bench_dihedrals.py topology.file trajectory.file
+
+Without arguments the small adenylate kinase trajectory from MDAnalysisTests is used.
+"""
+import os
+import sys
+import time
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from MDAnalysis import Universe
+from dihedrals import DihedralKernel, compute_angles
+
+SELECTIONS = {'ramachandran': 'protein',
+              'janin': 'protein and not resname ALA CYS* GLY PRO SER THR VAL'}
+
+def circular_difference(a, b):
+    "Largest difference between two arrays of angles in degrees"
+    d = np.abs(a - b) % 360
+    return np.nanmax(np.minimum(d, 360 - d))
+
+def compare(u, kind, tolerance=1e-3):
+    ag = u.select_atoms(SELECTIONS[kind])
+    t = time.perf_counter()
+    reference = compute_angles(ag, kind, 'mdanalysis')
+    t_mda = time.perf_counter() - t
+    t = time.perf_counter()
+    angles = DihedralKernel(ag, kind).run()
+    t_numpy = time.perf_counter() - t
+    diff = circular_difference(reference, angles)
+    print('%-12s frames: %d residues: %d' % (kind, *angles.shape[:2]))
+    print('    mdanalysis %8.3f s   numpy %8.3f s   speedup %5.1fx' % (t_mda, t_numpy, t_mda/t_numpy))
+    print('    largest difference %.2e deg %s' % (diff, 'OK' if diff < tolerance else 'MISMATCH'))
+    return diff < tolerance
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        topology, trajectory = sys.argv[1], sys.argv[2]
+    else:
+        from MDAnalysisTests.datafiles import PSF, DCD
+        topology, trajectory = PSF, DCD
+    u = Universe(topology, trajectory)
+    ok = [compare(u, kind) for kind in SELECTIONS]
+    sys.exit(0 if all(ok) else 1)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Compares the batched HistogramEngine with one Datashader Canvas.points call
+per residue (the way the images used to be made): checks that the counts and
+the shaded images are identical and reports the time each one takes.
+
+    ./benchmarks/bench_histograms.py [nframes] [nresidues]
+"""
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import datashader as ds
+from datashader.colors import viridis
+from histograms import HistogramEngine
+
+def random_angles(nframes, nresidues, seed=0):
+    """Table of float32 phi/psi angles scattered around the alpha helix and
+    beta sheet regions, including the edges of the canvas and NaNs
+    """
+    rng = np.random.default_rng(seed)
+    centres = np.array([[-63, -43], [-120, 130]])[rng.integers(0, 2, nresidues)].reshape(-1)
+    angles = centres + rng.normal(0, 15, (nframes, 2*nresidues))
+    angles = ((angles + 180) % 360 - 180).astype(np.float32)
+    angles[0,:] = 180
+    angles[1,:] = -180
+    angles[2,::3] = np.nan
+    return pd.DataFrame(angles)
+
+def datashader_counts(cvs, df):
+    aggs = []
+    for r in range(df.shape[1]//2):
+        phi_psi = df[[2*r,2*r+1]]
+        phi_psi.columns = ['Phi','Psi']
+        aggs.append(cvs.points(phi_psi,'Phi','Psi'))
+    return aggs
+
+if __name__ == "__main__":
+    nframes = int(sys.argv[1]) if len(sys.argv) > 1 else 40000
+    nresidues = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    df = random_angles(nframes, nresidues)
+    cvs = ds.Canvas(plot_width=500, plot_height=500, x_range=(-180,180), y_range=(-180,180))
+    engine = HistogramEngine.from_canvas(cvs, dims=('Phi','Psi'))
+    angles = df.values
+    engine.counts(angles[:10,0:2:2], angles[:10,1:2:2]) # numba compilation
+
+    t = time.perf_counter()
+    aggs = datashader_counts(cvs, df)
+    t_ds = time.perf_counter() - t
+    t = time.perf_counter()
+    cube = engine.counts(angles[:,0::2], angles[:,1::2])
+    t_numba = time.perf_counter() - t
+    t = time.perf_counter()
+    cube_np = engine.counts_numpy(angles[:,0::2], angles[:,1::2])
+    t_numpy = time.perf_counter() - t
+
+    same = all((agg.values == cube[r]).all() for r, agg in enumerate(aggs)) and (cube == cube_np).all()
+    for r in (0, nresidues-1):
+        a = np.asarray(ds.tf.shade(aggs[r], cmap=viridis).to_pil())
+        b = np.asarray(ds.tf.shade(engine.aggregate(cube[r]), cmap=viridis).to_pil())
+        same = same and (a == b).all()
+    print('frames: %d residues: %d' % (nframes, nresidues))
+    print('    datashader per residue %8.3f s' % t_ds)
+    print('    engine (numba)         %8.3f s   speedup %6.1fx' % (t_numba, t_ds/t_numba))
+    print('    engine (numpy)         %8.3f s   speedup %6.1fx' % (t_numpy, t_ds/t_numpy))
+    print('    counts and images %s' % ('identical' if same else 'DIFFERENT'))
+    sys.exit(0 if same else 1)
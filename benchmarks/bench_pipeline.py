@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Times every stage of RamachandranPlots, JaninPlots and RupturePlots on a
+synthetic trajectory (see synthetic.py, nothing is downloaded) and appends the
+wall and CPU time, frames per second and peak memory of every stage, with the
+commit and the sizes, as one line to a results file (JSON lines). The stages
+are compared with the last earlier result of the same sizes, e.g. from
+another commit.
+
+    ./benchmarks/bench_pipeline.py [--frames 10000] [--residues 200] [--chains 2]
+                                   [--parts rama janin ruptures] [--workers 1]
+                                   [--results benchmarks/results.jsonl]
+
+The trajectories are kept in --data and made again only for new sizes.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import warnings
+import subprocess
+import importlib.util
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+from synthetic import synthetic_system
+from instrument import RunReport
+
+def commit():
+    "Commit of the repository, with + if it has uncommitted changes"
+    try:
+        head = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+        return head + ('+' if dirty else '') if head else None
+    except OSError:
+        return None
+
+def load_ruptures():
+    "ruptures.py of the repository, imported as batch.load_ruptures does"
+    spec = importlib.util.spec_from_file_location('batch', os.path.join(ROOT, 'batch.py'))
+    batch = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(batch)
+    return batch.load_ruptures()
+
+def stages(report_path, part):
+    "Measurements of the stages in the run report at report_path, named part/stage"
+    with open(report_path) as f:
+        report = json.load(f)
+    return {'%s/%s' % (part, s['stage']): s for s in report['stages']}
+
+def bench_plots(Plots, part, topology, trajectory, directory, args):
+    "Runs RamachandranPlots or JaninPlots from scratch in directory and returns its stages"
+    from ramachandran import Universe
+    plots = Plots(Universe(topology, trajectory), workers=args.workers, engine=args.engine, directory=directory)
+    plots.n = args.n
+    plots.run(resume=False, profile=args.profile)
+    return stages(plots.report.path, part)
+
+def bench_ruptures(directory, args):
+    """Removes the spikes and detects the change points of the angles saved by
+    RamachandranPlots in directory, measured like the stages of run()
+    """
+    ruptureplots = load_ruptures()
+    report = RunReport(os.path.join(directory, 'ruptures_report.json'), 'ruptures',
+                       os.path.join(directory, 'profiles') if args.profile else None)
+    unwrapped = os.path.join(directory, 'rama_all_no_spikes.json')
+    rup = ruptureplots.RupturePlots(os.path.join(directory, 'rama_all.json'))
+    with report.stage('remove_spikes', frames=rup.nframes):
+        rup.remove_spikes(unwrapped, args.mode)
+    rup = ruptureplots.RupturePlots(unwrapped, workers=args.workers)
+    # Enough samples for the window even in short trajectories
+    rup.skip = max(1, min(rup.skip, rup.nframes//(4*rup.width)))
+    with report.stage('compute_change_points', frames=rup.nframes, skip=rup.skip):
+        rup.compute_change_points()
+    if args.plot:
+        figures = os.path.join(directory, 'ruptures')
+        os.makedirs(figures, exist_ok=True)
+        with report.stage('make_figures'):
+            rup.make_figures(True, figures)
+    return stages(report.path, 'ruptures')
+
+def earlier(results, entry):
+    "The last result in the file results with the same sizes and settings as entry"
+    if not os.path.exists(results):
+        return None
+    match = None
+    with open(results) as f:
+        for line in f:
+            old = json.loads(line)
+            if old['config'] == entry['config']:
+                match = old
+    return match
+
+def compare(old, new):
+    "Prints the time and memory of the stages of new next to the ones of old"
+    print('%-48s %10s %10s %8s %10s' % ('stage', 'seconds', 'before', 'ratio', 'peak MB'))
+    for name, s in new['stages'].items():
+        before = old['stages'].get(name, {}).get('wall_s') if old else None
+        ratio = '%7.2fx' % (s['wall_s']/before) if before else ''
+        print('%-48s %10.3f %10s %8s %10.1f' % (name, s['wall_s'], '%.3f' % before if before else '',
+                                               ratio, s['peak_rss_bytes']/2**20))
+    if old:
+        print('before: commit %s on %s' % (old['commit'], old['date']))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Times the stages of MDavocado on a synthetic trajectory')
+    parser.add_argument('--frames', type=int, default=10000)
+    parser.add_argument('--residues', type=int, default=200)
+    parser.add_argument('--chains', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--parts', nargs='+', default=['rama', 'janin', 'ruptures'], choices=['rama', 'janin', 'ruptures'])
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--engine', default='numpy', choices=['numpy', 'mdanalysis'])
+    parser.add_argument('--n', type=int, default=10, help='Number of slices')
+    parser.add_argument('--mode', default='legacy', help='Spike removal mode of ruptures')
+    parser.add_argument('--plot', action='store_true', help='Also time the figures of ruptures')
+    parser.add_argument('--profile', action='store_true', help='cProfile every stage into the run directory')
+    parser.add_argument('--data', default=os.path.join(HERE, 'data'), help='Directory of the synthetic trajectories')
+    parser.add_argument('--results', default=os.path.join(HERE, 'results.jsonl'))
+    parser.add_argument('--keep', action='store_true', help='Keep the images and angles of the run')
+    args = parser.parse_args()
+    warnings.filterwarnings('ignore', category=DeprecationWarning)
+
+    t = time.perf_counter()
+    topology, trajectory = synthetic_system(args.data, args.frames, args.residues, args.chains, args.seed)
+    print('Synthetic trajectory ready in %.1f s' % (time.perf_counter() - t))
+    directory = os.path.join(args.data, 'run_' + os.path.splitext(os.path.basename(trajectory))[0])
+    shutil.rmtree(directory, ignore_errors=True)
+    from ramachandran import RamachandranPlots, JaninPlots
+    measured = {}
+    if 'rama' in args.parts or 'ruptures' in args.parts: # ruptures needs the angles of rama
+        measured.update(bench_plots(RamachandranPlots, 'rama', topology, trajectory, directory, args))
+    if 'janin' in args.parts:
+        measured.update(bench_plots(JaninPlots, 'janin', topology, trajectory, directory, args))
+    if 'ruptures' in args.parts:
+        measured.update(bench_ruptures(directory, args))
+
+    keys = ('wall_s', 'cpu_s', 'children_cpu_s', 'peak_rss_bytes', 'frames', 'frames_per_s', 'read_bytes', 'write_bytes')
+    entry = {'commit': commit(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+             'host': os.uname().nodename, 'cpus': os.cpu_count(),
+             'config': {'frames': args.frames, 'residues': args.residues, 'chains': args.chains, 'seed': args.seed,
+                        'parts': sorted(args.parts), 'workers': args.workers, 'engine': args.engine, 'n': args.n,
+                        'mode': args.mode, 'plot': args.plot},
+             'stages': {name: {k: s.get(k) for k in keys} for name, s in measured.items()}}
+    compare(earlier(args.results, entry), entry)
+    with open(args.results, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+    print('Results appended to %s' % args.results)
+    if not args.keep:
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Synthetic multi-chain proteins and trajectories of any size, for benchmarks
+which need no downloads.
+
+The topology is a PDB file of chains of repeating residues (GLY, ALA, SER,
+LYS, LEU, GLU) with all the atoms of their phi/psi and chi1/chi2 dihedrals
+and CONECT records for the bonds, so that every chain is a fragment (all
+chains are in one segment, numbered through, as in e.g. a GROMACS system). The
+trajectory is a DCD file in which every atom moves randomly around its place,
+and the side chains flip at random frames, which gives the Ramachandran and
+Janin histograms some structure and ruptures some change points.
+
+    ./benchmarks/synthetic.py directory [nframes] [nresidues] [nchains]
+"""
+import os
+import sys
+import numpy as np
+
+# Atom names and positions (relative to the residue) of every residue type,
+# the side chain atoms after the backbone N, CA, C, O
+BACKBONE = [('N', (0.0, 0.0, 0.0)), ('CA', (1.2, 0.8, 0.0)), ('C', (2.4, 0.0, 0.3)), ('O', (2.4, -1.2, 0.3))]
+SIDECHAINS = {'GLY': [],
+              'ALA': [('CB', (1.2, 1.8, 1.0))],
+              'SER': [('CB', (1.2, 1.8, 1.0)), ('OG', (1.8, 2.8, 1.5))],
+              'LYS': [('CB', (1.2, 1.8, 1.0)), ('CG', (1.8, 2.8, 1.5)), ('CD', (1.2, 3.8, 2.2)), ('CE', (1.8, 4.8, 2.7))],
+              'LEU': [('CB', (1.2, 1.8, 1.0)), ('CG', (1.8, 2.8, 1.5)), ('CD1', (1.2, 3.8, 2.2))],
+              'GLU': [('CB', (1.2, 1.8, 1.0)), ('CG', (1.8, 2.8, 1.5)), ('CD', (1.2, 3.8, 2.2))]}
+SEQUENCE = ['GLY', 'ALA', 'LYS', 'SER', 'LEU', 'GLU']
+CHAIN_IDS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
+RISE = 3.8 # Distance between residues along a chain
+SPACING = 20.0 # Distance between chains
+
+def chain_lengths(nresidues, nchains):
+    "Residues of every chain, as even as possible (the first chains get the rest)"
+    return [nresidues//nchains + (c < nresidues % nchains) for c in range(nchains)]
+
+def build_protein(nresidues, nchains=1):
+    """Atoms (chain, resid, resname, name, position) and bonds (pairs of atom
+    indices) of nresidues residues in nchains straight, parallel chains
+    """
+    if nchains > len(CHAIN_IDS):
+        raise ValueError("At most %d chains fit into a PDB file" % len(CHAIN_IDS))
+    atoms, bonds = [], []
+    resid = 0 # Numbered through all chains, which are in one segment
+    for c, length in enumerate(chain_lengths(nresidues, nchains)):
+        previous_c = None
+        for r in range(length):
+            resname = SEQUENCE[r % len(SEQUENCE)]
+            origin = np.array([r*RISE, c*SPACING, 0.0])
+            index = {}
+            resid += 1
+            for name, offset in BACKBONE + SIDECHAINS[resname]:
+                index[name] = len(atoms)
+                atoms.append((CHAIN_IDS[c], resid, resname, name, origin + offset))
+            names = [name for name, _ in BACKBONE + SIDECHAINS[resname]]
+            bonds += [(index['N'], index['CA']), (index['CA'], index['C']), (index['C'], index['O'])]
+            side = ['CA'] + names[4:]
+            bonds += [(index[a], index[b]) for a, b in zip(side[:-1], side[1:])]
+            if previous_c is not None: # Peptide bond
+                bonds.append((previous_c, index['N']))
+            previous_c = index['C']
+    return atoms, bonds
+
+def write_topology(path, nresidues, nchains=1):
+    "Writes the protein as a PDB file with CONECT records, returns the positions of its atoms"
+    atoms, bonds = build_protein(nresidues, nchains)
+    if len(atoms) > 99999:
+        raise ValueError("%d atoms do not fit into a PDB file" % len(atoms))
+    neighbours = [[] for _ in atoms]
+    for a, b in bonds:
+        neighbours[a].append(b)
+        neighbours[b].append(a)
+    with open(path, 'w') as f:
+        for i, (chain, resid, resname, name, (x, y, z)) in enumerate(atoms):
+            f.write('ATOM  %5d %-4s %3s %1s%4d    %8.3f%8.3f%8.3f  1.00  0.00      %-4s%2s\n'
+                    % (i + 1, name if len(name) == 4 else ' ' + name, resname, chain, resid % 10000,
+                       x, y, z, 'PROT', name[0]))
+        for i, bonded in enumerate(neighbours):
+            for k in range(0, len(bonded), 4):
+                f.write('CONECT%5d' % (i + 1) + ''.join('%5d' % (j + 1) for j in bonded[k:k+4]) + '\n')
+        f.write('END\n')
+    return np.array([a[4] for a in atoms], dtype=np.float32)
+
+def write_trajectory(topology, path, nframes, noise=0.4, flips=4, chunk=1000, seed=0):
+    """Writes nframes frames of the protein in topology to the DCD file path.
+    Every atom moves around its place by noise (in Angstrom) and the side chain
+    of every residue flips to the other side of the backbone up to flips times.
+    The frames are made chunk at a time, so memory does not depend on nframes.
+    """
+    from MDAnalysis import Universe, Writer
+    u = Universe(topology)
+    rng = np.random.default_rng(seed)
+    reference = u.atoms.positions.copy()
+    side = ~np.isin(u.atoms.names, [name for name, _ in BACKBONE])
+    residue = u.atoms.resindices
+    nres = len(u.residues)
+    switches = np.sort(rng.integers(0, nframes, (nres, flips)), axis=1) # Frames where a side chain flips
+    with Writer(path, n_atoms=len(u.atoms), format='DCD') as w:
+        for start in range(0, nframes, chunk):
+            frames = np.arange(start, min(start + chunk, nframes))
+            flipped = (np.sum(switches[None,:,:] <= frames[:,None,None], axis=2) % 2).astype(bool)
+            sign = np.where(flipped[:, residue] & side, -1.0, 1.0).astype(np.float32)
+            xyz = np.repeat(reference[None], len(frames), axis=0)
+            xyz[:,:,2] *= sign
+            xyz += rng.normal(0, noise, xyz.shape).astype(np.float32)
+            for positions in xyz:
+                u.atoms.positions = positions
+                w.write(u.atoms)
+
+def synthetic_system(directory, nframes, nresidues, nchains=1, seed=0):
+    """Topology and trajectory (paths) of a synthetic protein in directory,
+    made only if they are not there yet
+    """
+    os.makedirs(directory, exist_ok=True)
+    stem = os.path.join(directory, 'synthetic_%dres_%dch_%dfr_%d' % (nresidues, nchains, nframes, seed))
+    topology, trajectory = stem + '.pdb', stem + '.dcd'
+    if not os.path.exists(topology):
+        write_topology(topology, nresidues, nchains)
+    if not os.path.exists(trajectory):
+        natoms = len(build_protein(nresidues, nchains)[0])
+        print('Writing %d frames of %d atoms (%.1f GB) to %s' % (nframes, natoms, nframes*natoms*12/1e9, trajectory))
+        write_trajectory(topology, trajectory + '.tmp', nframes, seed=seed)
+        os.replace(trajectory + '.tmp', trajectory) # Never a half written trajectory
+    return topology, trajectory
+
+if __name__ == "__main__":
+    directory = sys.argv[1] if len(sys.argv) > 1 else '.'
+    nframes = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    nresidues = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    nchains = int(sys.argv[4]) if len(sys.argv) > 4 else 2
+    print(*synthetic_system(directory, nframes, nresidues, nchains))
@@ -0,0 +1,180 @@
+"""
+Blockwise circular correlation of the columns of a table of angles.
+
+The dense correlation matrix of all the angles of a large protein (e.g. 2800
+phi/psi columns) has millions of cells of which only a few strong ones are
+kept. Here the sines of the angles are computed for chunks of frames at a time
+and their cross products are summed into a block of rows of the matrix only,
+so that just the strong correlations of each block are kept, as sparse pairs.
+"""
+import os
+import json
+import pickle
+import numpy as np
+import pandas as pd
+from anglestore import circular_means
+
+class CircularCorrelation:
+    """
+    Circular correlation coefficients (as astropy circcorrcoef, with the circular
+    mean of each column) between all columns of a table of angles in degrees
+    (nframes, ncolumns), e.g. an AngleStore. Rows of the table are read chunk at
+    a time and the matrix is made block rows at a time.
+    """
+
+    def __init__(self, table, chunk=2048, block=512):
+        self.table = np.asarray(table) # No copy for a DataFrame over the memmap
+        self.chunk, self.block = chunk, block
+        self.ncolumns = self.table.shape[1]
+        self.mean = self.circular_means()
+        self.norm = np.sqrt(sum((np.sin(x - self.mean)**2).sum(axis=0) for x in self.chunks()))
+
+    def chunks(self, start=0):
+        "Angles of the columns from start on in radians (float64), chunk frames at a time"
+        for i in range(0, len(self.table), self.chunk):
+            yield np.radians(self.table[i:i+self.chunk, start:].astype(np.float64))
+
+    def circular_means(self):
+        "Circular mean of every column in radians (as astropy circmean)"
+        return np.radians(circular_means(self.table, self.chunk))
+
+    def pairs(self, limit=0.5, band=1):
+        """Strong correlations as sparse arrays (rows, columns, r) of all pairs
+        of columns i < j with |r| > limit, except those closer than band + 1
+        to the diagonal (by default the angles of the same and neighbouring residues).
+        """
+        rows, columns, values = [], [], []
+        for a in range(0, self.ncolumns, self.block):
+            b = min(a + self.block, self.ncolumns)
+            tile = np.zeros((b - a, self.ncolumns - a)) # Rows a:b, columns a: of the matrix
+            for x in self.chunks(a):
+                s = np.sin(x - self.mean[a:])
+                tile += s[:, :b-a].T @ s
+            with np.errstate(divide='ignore', invalid='ignore'):
+                r = tile/np.outer(self.norm[a:b], self.norm[a:])
+            i, j = np.nonzero(np.abs(r) > limit)
+            keep = j - i > band
+            rows.append(i[keep] + a)
+            columns.append(j[keep] + a)
+            values.append(r[i[keep], j[keep]])
+        return np.concatenate(rows), np.concatenate(columns), np.concatenate(values)
+
+class SlidingCorrelation:
+    """
+    Circular correlation coefficients in sliding windows of width consecutive
+    slices of the table (slice edges in frames, as from slices()), each with
+    the circular means of its own frames.
+
+    For every slice the sums of sin and cos of the angles and of their cross
+    products are added to running window sums as the slice enters the window
+    and subtracted as it leaves. With sin(x - m) = sin x cos m - cos x sin m
+    the coefficients of any window follow from those sums and the window means,
+    so the table is read once per block of rows whatever the number of windows.
+    """
+
+    def __init__(self, table, frames, width=1, chunk=2048, block=512):
+        self.table = np.asarray(table)
+        self.frames = list(frames)
+        self.width, self.chunk, self.block = width, chunk, block
+        self.ncolumns = self.table.shape[1]
+        self.windows = [(self.frames[i], self.frames[i+width]) for i in range(len(self.frames)-width)]
+        # Column sums of sin, cos, sin^2, sin*cos and cos^2 of every window
+        self.sums = list(self.sliding(self.column_sums(a, b) for a, b in zip(self.frames[:-1], self.frames[1:])))
+
+    def chunks(self, a, b, start=0):
+        "Angles of the frames a:b and the columns from start on in radians, chunk frames at a time"
+        for i in range(a, b, self.chunk):
+            yield np.radians(self.table[i:min(i+self.chunk, b), start:].astype(np.float64))
+
+    def column_sums(self, a, b):
+        sums = np.zeros((5, self.ncolumns))
+        for x in self.chunks(a, b):
+            s, c = np.sin(x), np.cos(x)
+            sums += [s.sum(axis=0), c.sum(axis=0), (s*s).sum(axis=0), (s*c).sum(axis=0), (c*c).sum(axis=0)]
+        return sums
+
+    def cross_sums(self, a, b, start, stop):
+        "Sums of sin*sin, sin*cos, cos*sin and cos*cos between columns start:stop and start: over frames a:b"
+        sums = np.zeros((4, stop - start, self.ncolumns - start))
+        for x in self.chunks(a, b, start):
+            s, c = np.sin(x), np.cos(x)
+            sums[0] += s[:, :stop-start].T @ s
+            sums[1] += s[:, :stop-start].T @ c
+            sums[2] += c[:, :stop-start].T @ s
+            sums[3] += c[:, :stop-start].T @ c
+        return sums
+
+    def sliding(self, sums):
+        "Running sums over width consecutive items of sums (one per slice)"
+        window, entered = None, []
+        for item in sums:
+            window = item.copy() if window is None else window + item
+            entered.append(item)
+            if len(entered) > self.width:
+                window -= entered.pop(0)
+            if len(entered) == self.width:
+                yield window
+
+    def pairs(self, limit=0.5, band=1):
+        """Strong correlations (rows, columns, r) of every window, as from
+        CircularCorrelation.pairs on the frames of the window alone
+        """
+        found = [[] for w in self.windows]
+        means = [np.arctan2(S, C) for S, C, SS, SC, CC in self.sums]
+        norms = []
+        for m, (S, C, SS, SC, CC) in zip(means, self.sums):
+            c, s = np.cos(m), np.sin(m)
+            norms.append(np.sqrt(np.maximum(SS*c*c - 2*SC*c*s + CC*s*s, 0)))
+        for a in range(0, self.ncolumns, self.block):
+            b = min(a + self.block, self.ncolumns)
+            slices = (self.cross_sums(f0, f1, a, b) for f0, f1 in zip(self.frames[:-1], self.frames[1:]))
+            for w, (ss, sc, cs, cc) in enumerate(self.sliding(slices)):
+                c, s = np.cos(means[w]), np.sin(means[w])
+                ci, si, cj, sj = c[a:b,None], s[a:b,None], c[None,a:], s[None,a:]
+                tile = ss*ci*cj - sc*ci*sj - cs*si*cj + cc*si*sj
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    r = tile/np.outer(norms[w][a:b], norms[w][a:])
+                i, j = np.nonzero(np.abs(r) > limit)
+                keep = j - i > band
+                found[w].append((i[keep] + a, j[keep] + a, r[i[keep], j[keep]]))
+        return [tuple(np.concatenate(p) for p in zip(*parts)) for parts in found]
+
+def both_ways(pairs):
+    "Pairs (i, j) of the upper triangle together with (j, i), ordered by column and row"
+    rows, columns, values = pairs
+    i, j = np.concatenate([rows, columns]), np.concatenate([columns, rows])
+    order = np.lexsort((i, j))
+    return i[order], j[order], np.concatenate([values, values])[order]
+
+def correlation_map(pairs, labels):
+    """Strong correlations as {labels[j]: {labels[i]: r}} for every angle j,
+    which is the format of JaninPlots.corr
+    """
+    corr = {}
+    for i, j, r in zip(*both_ways(pairs)):
+        corr.setdefault(labels[j], {})[labels[i]] = float(r)
+    return corr
+
+def truncated_matrix(pairs, labels):
+    """DataFrame of the correlations between only the angles which have some
+    strong correlation (NaN for all the others), labelled with labels
+    """
+    i, j, r = both_ways(pairs)
+    keep = np.unique(i)
+    position = np.searchsorted(keep, [i, j])
+    cm = np.full((len(keep), len(keep)), np.nan)
+    cm[position[0], position[1]] = r
+    names = [labels[k] for k in keep]
+    return pd.DataFrame(cm, index=names, columns=names)
+
+def json_map(corr):
+    "corr with the labels (tuples) joined into strings, e.g. 'PHE A 12 phi', for JSON"
+    name = lambda label: ' '.join(map(str, label)) if isinstance(label, tuple) else str(label)
+    return {name(k): json_map(v) if isinstance(v, dict) else v for k, v in corr.items()}
+
+def save_correlations(corr, path):
+    "Saves the strong correlations corr to path (.pkl) and as JSON (.json)"
+    with open(path, 'wb') as f:
+        pickle.dump(corr, f)
+    with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+        json.dump(json_map(corr), f, indent=1)
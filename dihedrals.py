@@ -0,0 +1,166 @@
+"""
+Vectorized dihedral angles.
+
+Instead of running MDAnalysis Ramachandran or Janin analysis (which select
+the atom groups again and calculate the angles frame by frame), the four atoms
+of every phi, psi, chi1 and chi2 dihedral are resolved only once as integer
+index arrays. All the dihedrals for a batch of frames are then calculated in
+a single NumPy pass over the (batch, natoms, 3) block of coordinates.
+"""
+import numpy as np
+from MDAnalysis.analysis.dihedrals import Ramachandran, Janin
+from MDAnalysis.lib.distances import minimize_vectors
+
+def ramachandran_quadruplets(atomgroup):
+    """Atom indices of the phi and psi dihedrals as an array (nresidues, 2, 4).
+    Residues are the same (and in the same order) as in MDAnalysis Ramachandran.
+    """
+    R = Ramachandran(atomgroup)
+    phi = np.stack([R.ag1.indices, R.ag2.indices, R.ag3.indices, R.ag4.indices], axis=1)
+    psi = np.stack([R.ag2.indices, R.ag3.indices, R.ag4.indices, R.ag5.indices], axis=1)
+    return np.stack([phi, psi], axis=1)
+
+def janin_quadruplets(atomgroup):
+    """Atom indices of the chi1 and chi2 dihedrals as an array (nresidues, 2, 4).
+    Residues are the same (and in the same order) as in MDAnalysis Janin.
+    """
+    J = Janin(atomgroup)
+    chi1 = np.stack([J.ag1.indices, J.ag2.indices, J.ag3.indices, J.ag4.indices], axis=1)
+    chi2 = np.stack([J.ag2.indices, J.ag3.indices, J.ag4.indices, J.ag5.indices], axis=1)
+    return np.stack([chi1, chi2], axis=1)
+
+QUADRUPLETS = {'ramachandran': ramachandran_quadruplets, 'janin': janin_quadruplets}
+
+def table_residue_group(atomgroup, kind):
+    """The residues (a ResidueGroup) in the order of the table of angles, the ones
+    MDAnalysis resolves the dihedrals of: e.g. without the first and last residue
+    of every segment for phi/psi, or only the residues with a CG for chi1/chi2
+    """
+    quads = QUADRUPLETS[kind](atomgroup)
+    return atomgroup.universe.residues[atomgroup.universe.atoms[quads[:,0,1]].resindices]
+
+def table_residues(atomgroup, kind):
+    "List of (segid, resid, resname) of the residues in the order of the table of angles"
+    residues = table_residue_group(atomgroup, kind)
+    return [(str(s), int(r), str(n)) for s, r, n in zip(residues.segids, residues.resids, residues.resnames)]
+
+def minimum_image(v, boxes):
+    """Applies the minimum image convention to the bond vectors v (batch, m, 3).
+    Orthorhombic boxes are handled for the whole batch at once,
+    triclinic ones frame by frame.
+    """
+    if boxes is None:
+        return v
+    if np.all(boxes[:,3:] == 90):
+        L = boxes[:,None,:3].astype(np.float64)
+        return v - L*np.round(v/L)
+    return np.stack([minimize_vectors(v[i], boxes[i]) for i in range(len(v))])
+
+def calc_dihedrals(block, quads, boxes=None):
+    """Dihedral angles in radians (batch, m) for the atom quadruplets quads (m, 4)
+    from the coordinates block (batch, natoms, 3).
+    Follows the same formula as MDAnalysis.lib.distances.calc_dihedrals.
+    """
+    a, b, c, d = (block[:,quads[:,i],:].astype(np.float64) for i in range(4))
+    va = minimum_image(b - a, boxes)
+    vb = minimum_image(c - b, boxes)
+    vc = minimum_image(d - c, boxes)
+    n1 = np.cross(va, vb)
+    n2 = np.cross(vb, vc)
+    x = np.einsum('ijk,ijk->ij', n1, n2)
+    y = np.einsum('ijk,ijk->ij', np.cross(n1, n2), vb)/np.linalg.norm(vb, axis=2)
+    angles = np.arctan2(y, x)
+    angles[(x == 0) & (y == 0)] = np.nan
+    return angles
+
+class DihedralKernel:
+    """
+    Calculates phi and psi (kind='ramachandran') or chi1 and chi2 (kind='janin')
+    for all residues of the atomgroup. The results have the same layout and units
+    as results['angles'] of the corresponding MDAnalysis analysis, i.e. an array
+    (nframes, nresidues, 2) in degrees.
+    """
+
+    def __init__(self, atomgroup, kind='ramachandran', batch=1000):
+        quads = QUADRUPLETS[kind](atomgroup)
+        self.kind = kind
+        self.batch = batch # Number of frames computed in one pass
+        self.universe = atomgroup.universe
+        self.nresidues = quads.shape[0]
+        # Only the atoms taking part in some dihedral are ever read
+        self.indices, quads = np.unique(quads.reshape(-1,4), return_inverse=True)
+        self.quads = quads.reshape(-1,4)
+        self.atoms = self.universe.atoms[self.indices]
+
+    def coordinates(self, start=None, end=None, step=1):
+        """Yields blocks of coordinates (batch, natoms, 3) and boxes (batch, 6)
+        for the frames start:end:step. Boxes are None if the trajectory has no unit cell.
+        """
+        frames = range(*slice(start, end, step).indices(self.universe.trajectory.n_frames))
+        for i in range(0, len(frames), self.batch):
+            chunk = frames[i:i+self.batch]
+            block = np.empty((len(chunk), len(self.indices), 3), dtype=np.float32)
+            boxes = np.empty((len(chunk), 6), dtype=np.float32)
+            for j, ts in enumerate(self.universe.trajectory[chunk.start:chunk.stop:chunk.step]):
+                block[j] = self.atoms.positions
+                boxes[j] = ts.dimensions if ts.dimensions is not None else np.nan
+            yield block, (None if np.isnan(boxes).any() else boxes)
+
+    def from_radians(self, radians):
+        "Converts dihedrals (batch, 2*nresidues) in radians to (batch, nresidues, 2) in degrees"
+        angles = np.rad2deg(radians)
+        if self.kind == 'janin':
+            angles = (angles + 360) % 360
+        return angles.reshape(len(radians), self.nresidues, 2)
+
+    def angles(self, block, boxes=None):
+        "Angles (batch, nresidues, 2) in degrees for a block of coordinates"
+        return self.from_radians(calc_dihedrals(block, self.quads, boxes))
+
+    def run(self, start=None, end=None, step=1):
+        "Angles (nframes, nresidues, 2) for the frames start:end:step"
+        blocks = [self.angles(block, boxes) for block, boxes in self.coordinates(start, end, step)]
+        if not blocks:
+            return np.empty((0, self.nresidues, 2))
+        return np.concatenate(blocks)
+
+class CombinedKernel(DihedralKernel):
+    """
+    Calculates the angles of several DihedralKernels (e.g. Ramachandran and Janin)
+    from a single pass over the trajectory. The results are lists with one array
+    for each of the kernels.
+    """
+
+    def __init__(self, kernels, batch=1000):
+        self.kernels = kernels
+        self.batch = batch
+        self.universe = kernels[0].universe
+        self.indices = np.unique(np.concatenate([k.indices for k in kernels]))
+        self.atoms = self.universe.atoms[self.indices]
+        # Quadruplets of every kernel as indices into the combined atoms
+        self.quads = [np.searchsorted(self.indices, k.indices[k.quads]) for k in kernels]
+
+    def angles(self, block, boxes=None):
+        "List of angles (batch, nresidues, 2) in degrees, one for each kernel"
+        return [k.from_radians(calc_dihedrals(block, q, boxes)) for k, q in zip(self.kernels, self.quads)]
+
+    def run(self, start=None, end=None, step=1):
+        "List of angles (nframes, nresidues, 2), one for each kernel, for the frames start:end:step"
+        blocks = [self.angles(block, boxes) for block, boxes in self.coordinates(start, end, step)]
+        if not blocks:
+            return [np.empty((0, k.nresidues, 2)) for k in self.kernels]
+        return [np.concatenate(b) for b in zip(*blocks)]
+
+def compute_angles(atomgroup, kind, engine='mdanalysis', start=None, end=None, kernel=None, step=1):
+    """Angles (nframes, nresidues, 2) for the frames start:end:step either from
+    the MDAnalysis analysis (engine='mdanalysis') or the DihedralKernel (engine='numpy').
+    An already built kernel can be passed to avoid resolving the atoms again.
+    """
+    if engine == 'numpy':
+        kernel = kernel or DihedralKernel(atomgroup, kind)
+        return kernel.run(start, end, step)
+    if engine == 'mdanalysis':
+        analysis = {'ramachandran': Ramachandran, 'janin': Janin}[kind]
+        A = analysis(atomgroup, verbose=True).run(start, end, step)
+        return A.results['angles']
+    raise ValueError("Unknown engine %r, use 'mdanalysis' or 'numpy'" % engine)
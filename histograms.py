@@ -0,0 +1,234 @@
+"""
+Batched 2D histograms of angles for all residues at once.
+
+Datashader needs one Canvas.points call (on a freshly sliced DataFrame)
+for every residue in every slice. Here the (x, y) angle pairs of all the
+residues for a block of frames are binned into a single count cube
+(nresidues, height, width) in one pass. The binning follows exactly the
+same rules as Datashader Canvas.points, so each slice of the cube can be
+shaded into the same image.
+"""
+import numpy as np
+import numba
+import xarray as xr
+
+@numba.njit(nogil=True)
+def _bin_pairs(x, y, cube, sx, tx, sy, ty, xmin, xmax, ymin, ymax):
+    # x and y are (nresidues, nframes), so each residue is read contiguously
+    # while its histogram stays in cache
+    nresidues, nframes = x.shape
+    height, width = cube.shape[1], cube.shape[2]
+    for r in range(nresidues):
+        for i in range(nframes):
+            xv, yv = x[r,i], y[r,i]
+            # Same as Datashader: points outside bounds (or NaN) are dropped
+            # and points on the upper bound go to the last pixel
+            if (xmin <= xv <= xmax) and (ymin <= yv <= ymax):
+                xx = int(xv*sx + tx)
+                yy = int(yv*sy + ty)
+                if xx >= width:
+                    xx = width - 1
+                if yy >= height:
+                    yy = height - 1
+                cube[r,yy,xx] += 1
+
+class HistogramEngine:
+    """
+    Counts of (x, y) angle pairs on a width x height grid covering
+    x_range and y_range, for all residues at once.
+    """
+
+    def __init__(self, x_range, y_range, width=500, height=500, dims=('x','y')):
+        self.x_range, self.y_range = x_range, y_range
+        self.width, self.height = width, height
+        self.dims = dims
+        # Scale and translation from data to pixels, as in Datashader
+        self.sx = width/(x_range[1] - x_range[0])
+        self.tx = -x_range[0]*self.sx
+        self.sy = height/(y_range[1] - y_range[0])
+        self.ty = -y_range[0]*self.sy
+
+    @classmethod
+    def from_canvas(cls, cvs, dims=('x','y')):
+        "Engine with the same ranges and size as the Datashader Canvas cvs"
+        return cls(cvs.x_range, cvs.y_range, cvs.plot_width, cvs.plot_height, dims)
+
+    def empty(self, nresidues):
+        return np.zeros((nresidues, self.height, self.width), dtype=np.uint32)
+
+    def counts(self, x, y, cube=None):
+        """Bins x and y, arrays (nframes, nresidues) of angles, into the count
+        cube (nresidues, height, width). Counts are added to cube if given.
+        """
+        x, y = np.asarray(x), np.asarray(y)
+        if cube is None:
+            cube = self.empty(x.shape[1])
+        x, y = np.ascontiguousarray(x.T), np.ascontiguousarray(y.T)
+        _bin_pairs(x, y, cube, self.sx, self.tx, self.sy, self.ty,
+                   self.x_range[0], self.x_range[1], self.y_range[0], self.y_range[1])
+        return cube
+
+    def counts_numpy(self, x, y, cube=None, block=64):
+        "Same as counts but in pure NumPy, binning block residues at a time"
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        if cube is None:
+            cube = self.empty(x.shape[1])
+        size = self.height*self.width
+        for r in range(0, x.shape[1], block):
+            xb, yb = x[:,r:r+block], y[:,r:r+block]
+            ok = (self.x_range[0] <= xb) & (xb <= self.x_range[1]) & (self.y_range[0] <= yb) & (yb <= self.y_range[1])
+            xx = np.minimum((xb*self.sx + self.tx)[ok].astype(np.int64), self.width - 1)
+            yy = np.minimum((yb*self.sy + self.ty)[ok].astype(np.int64), self.height - 1)
+            res = np.broadcast_to(np.arange(xb.shape[1]), xb.shape)[ok]
+            flat = np.bincount(res*size + yy*self.width + xx, minlength=xb.shape[1]*size)
+            cube[r:r+block] += flat.reshape(-1, self.height, self.width).astype(np.uint32)
+        return cube
+
+    def aggregate(self, counts):
+        """The counts (height, width) of one residue as a DataArray
+        like the one returned by Datashader Canvas.points, ready for shading.
+        """
+        xs = self.x_range[0] + (np.arange(self.width) + 0.5)/self.sx
+        ys = self.y_range[0] + (np.arange(self.height) + 0.5)/self.sy
+        x, y = self.dims
+        return xr.DataArray(counts, coords=[(y, ys), (x, xs)])
+
+class HistogramCube:
+    """
+    Histogram counts of every residue in every slice of the trajectory,
+    kept sparse (only the non-empty pixels) and saved compressed to a .npz file,
+    so that images, gifs and montages can be made again without the angles.
+    """
+
+    def __init__(self, frames, nresidues, x_range, y_range, width=500, height=500, dims=('x','y')):
+        self.frames = list(frames) # Slice edges in frame numbers
+        self.nresidues = nresidues
+        self.engine = HistogramEngine(x_range, y_range, width, height, dims)
+        self.slices = {} # Slice number -> (flat indices, counts) of non-empty pixels
+
+    @classmethod
+    def for_engine(cls, engine, frames, nresidues):
+        "Empty cube with the ranges and size of the HistogramEngine engine"
+        return cls(frames, nresidues, engine.x_range, engine.y_range, engine.width, engine.height, engine.dims)
+
+    @property
+    def shape(self):
+        return (self.nresidues, self.engine.height, self.engine.width)
+
+    def add(self, i, counts):
+        "Stores the dense counts (nresidues, height, width) of slice i"
+        index = np.flatnonzero(counts)
+        self.slices[i] = (index, counts.reshape(-1)[index])
+
+    def dense(self, i):
+        "Dense counts (nresidues, height, width) of slice i"
+        counts = np.zeros(np.prod(self.shape), dtype=np.uint32)
+        index, values = self.slices[i]
+        counts[index] = values
+        return counts.reshape(self.shape)
+
+    def residue(self, i, r, cumulative=False):
+        """Dense counts (height, width) of residue r in slice i,
+        or in all slices up to i if cumulative
+        """
+        size = self.engine.height*self.engine.width
+        counts = np.zeros(size, dtype=np.uint32)
+        for j in (range(i+1) if cumulative else [i]):
+            index, values = self.slices[j]
+            lo, hi = np.searchsorted(index, [r*size, (r+1)*size])
+            counts[index[lo:hi] - r*size] += values[lo:hi]
+        return counts.reshape(self.engine.height, self.engine.width)
+
+    def residue_slices(self, r, slices=None, cumulative=False):
+        """(i, dense counts (height, width)) of residue r in the slices i (all by default),
+        or in all slices up to i if cumulative: a running sum, so every slice is
+        read only once (the same array is yielded each time, as by cumulative)
+        """
+        slices = sorted(range(len(self.frames)-1) if slices is None else slices)
+        if not cumulative:
+            for i in slices:
+                yield i, self.residue(i, r)
+            return
+        wanted = set(slices)
+        total = np.zeros((self.engine.height, self.engine.width), dtype=np.uint32)
+        for i in range(slices[-1] + 1 if slices else 0):
+            total += self.residue(i, r)
+            if i in wanted:
+                yield i, total
+
+    def find(self, start, end):
+        "Number of the slice from frame start to end, None if there is no such slice"
+        if start in self.frames[:-1]:
+            i = self.frames.index(start)
+            if self.frames[i+1] == end:
+                return i
+        return None
+
+    def __iter__(self):
+        "Dense counts of the slices in order"
+        for i in range(len(self.frames)-1):
+            yield self.dense(i)
+
+    def cumulative(self):
+        """Counts of all frames from the start up to the end of each slice
+        as prefix sums over the slices (the aggregate=True view).
+        """
+        total = np.zeros(self.shape, dtype=np.uint32)
+        for counts in self:
+            total += counts
+            yield total
+
+    def save(self, path):
+        "Saves all slices, the ones not added yet as empty (e.g. while binning)"
+        n = len(self.frames) - 1
+        empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint32))
+        slices = [self.slices.get(i, empty) for i in range(n)]
+        index = [s[0] for s in slices]
+        np.savez_compressed(path,
+                            frames=np.array(self.frames),
+                            shape=np.array(self.shape),
+                            ranges=np.array([self.engine.x_range, self.engine.y_range], dtype=float),
+                            dims=np.array(self.engine.dims),
+                            ptr=np.cumsum([0] + [len(i) for i in index]),
+                            index=np.concatenate(index),
+                            counts=np.concatenate([s[1] for s in slices]))
+
+    @classmethod
+    def load(cls, path):
+        f = np.load(path)
+        nresidues, height, width = f['shape']
+        (x_range, y_range), dims = f['ranges'], tuple(f['dims'])
+        cube = cls([int(i) for i in f['frames']], int(nresidues), tuple(x_range), tuple(y_range), int(width), int(height), dims)
+        ptr, index, counts = f['ptr'], f['index'], f['counts']
+        for i in range(len(ptr)-1):
+            cube.slices[i] = (index[ptr[i]:ptr[i+1]], counts[ptr[i]:ptr[i+1]])
+        return cube
+
+    def merged(self, frames):
+        """Cube with fewer, longer slices given by their edges frames,
+        which all have to be edges of the slices in this cube.
+        """
+        frames = list(frames)
+        if not set(frames) <= set(self.frames):
+            raise ValueError("Slices %s do not fit the saved slices %s" % (frames, self.frames))
+        cube = HistogramCube(frames, self.nresidues, self.engine.x_range, self.engine.y_range,
+                             self.engine.width, self.engine.height, self.engine.dims)
+        for i in range(len(frames)-1):
+            a, b = self.frames.index(frames[i]), self.frames.index(frames[i+1])
+            cube.add(i, sum(self.dense(j) for j in range(a, b)))
+        return cube
+
+    def resized(self, width, height):
+        """Cube with histograms of width x height pixels. Pixels are summed in blocks,
+        so the saved size has to be a multiple of the new one.
+        """
+        fx, fy = self.engine.width//width, self.engine.height//height
+        if fx*width != self.engine.width or fy*height != self.engine.height:
+            raise ValueError("Histograms of %dx%d can not be resized to %dx%d"
+                             % (self.engine.width, self.engine.height, width, height))
+        cube = HistogramCube(self.frames, self.nresidues, self.engine.x_range, self.engine.y_range,
+                             width, height, self.engine.dims)
+        for i in range(len(self.frames)-1):
+            counts = self.dense(i).reshape(self.nresidues, height, fy, width, fx).sum(axis=(2,4))
+            cube.add(i, counts.astype(np.uint32))
+        return cube
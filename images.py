@@ -0,0 +1,116 @@
+"""
+In-process image operations with Pillow.
+
+These replace the ImageMagick convert, mogrify and montage commands which used
+to be started (and had to decode the PNG files again) once or more for every
+residue in every slice.
+
+The animations are saved as GIF (256 colours), lossless WebP or APNG, by the
+extension of their path, see ANIMATIONS.
+"""
+import os
+from math import ceil, sqrt
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageDraw, ImageFont
+
+ANIMATIONS = {'gif': '.gif', 'webp': '.webp', 'apng': '.apng'} # Format of the animations -> extension
+
+def font(pointsize):
+    "DejaVu Sans (as used by ImageMagick) if available, otherwise Pillow's own font"
+    try:
+        return ImageFont.truetype('DejaVuSans.ttf', pointsize)
+    except OSError:
+        return ImageFont.load_default(pointsize)
+
+def blank(size=(500,500)):
+    "White image, e.g. for residues which do not have the angles"
+    return Image.new('RGB', size, 'white')
+
+def annotate(img, text, pointsize=50, gravity='South'):
+    """Draws text in black at the bottom centre (gravity='South')
+    or at the bottom right corner (gravity='SouthEast') of img
+    """
+    draw = ImageDraw.Draw(img)
+    f = font(pointsize)
+    left, top, right, bottom = draw.textbbox((0,0), text, font=f)
+    x = img.width - right if gravity == 'SouthEast' else (img.width - right - left)//2
+    draw.text((x, img.height - bottom), text, fill='black', font=f)
+    return img
+
+def montage(images, tile=100, columns=None):
+    """Combines images into a grid of tile x tile thumbnails,
+    with about as many columns as rows unless columns is given
+    """
+    columns = columns or ceil(sqrt(len(images)))
+    return sprite_sheet(images, columns, ceil(len(images)/columns), tile)
+
+def sprite_sheet(images, columns, rows, tile=100):
+    """Pastes images row by row into a grid of columns x rows tile x tile thumbnails.
+    images can be any iterable, only one of them is held at a time.
+    """
+    sheet = Image.new('RGB', (columns*tile, rows*tile), 'white')
+    for k, img in enumerate(images):
+        thumb = img.resize((tile, tile), Image.LANCZOS)
+        sheet.paste(thumb, ((k % columns)*tile, (k//columns)*tile), thumb if thumb.mode == 'RGBA' else None)
+    return sheet
+
+def save_gif(frames, path, delay=10):
+    """Saves frames as a looping animated GIF to path (or a file object),
+    delay in 1/100 s (like convert -dispose previous -delay 10 -loop 0)
+    """
+    frames[0].save(path, format='GIF', save_all=True, append_images=frames[1:], duration=delay*10, loop=0, disposal=3)
+
+def save_animation(frames, path, delay=10):
+    """Saves frames as a looping animation to path, as a GIF, a lossless WebP
+    or an APNG (which keep all colours of the shading) by its extension
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.gif':
+        return save_gif(frames, path, delay)
+    options = {'.webp': {'format': 'WEBP', 'lossless': True, 'method': 4},
+               '.apng': {'format': 'PNG'}}[ext]
+    frames[0].save(path, save_all=True, append_images=frames[1:], duration=delay*10, loop=0, **options)
+
+def open_images(paths, size=(500,500)):
+    "Images from paths in the given order, blank ones for missing files"
+    images = []
+    for path in paths:
+        if os.path.exists(path):
+            with Image.open(path) as img:
+                images.append(img.convert('RGBA'))
+        else:
+            images.append(blank(size))
+    return images
+
+def make_gif(paths, path, size=(500,500)):
+    """Animation at path (or at each of a list of paths, in any of the
+    ANIMATIONS) from the images at paths (in that order), read only once
+    """
+    frames = open_images(paths, size)
+    for p in [path] if isinstance(path, str) else path:
+        save_animation(frames, p)
+
+def chain_montage(chain, pngs, tiles, gif):
+    """Tiles the residue images of a chain for every slice, labels each tile
+    with the chain name and saves it, and combines all tiles into the gif
+    (or into each of a list of animations, see save_animation).
+    pngs is a list (one item per slice) of lists of residue image paths,
+    tiles the paths of the tiles (one per slice).
+    """
+    frames = []
+    for files, tile_path in zip(pngs, tiles):
+        tile = annotate(montage(open_images(files)), chain, pointsize=70, gravity='SouthEast')
+        tile.save(tile_path)
+        frames.append(tile)
+    for path in [gif] if isinstance(gif, str) else gif:
+        save_animation(frames, path)
+
+def map_jobs(func, jobs, workers=1):
+    """Calls func(*job) for every job, in a pool of workers processes if workers > 1.
+    All paths in the jobs have to be explicit, as the processes share no working directory.
+    """
+    jobs = list(jobs)
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(workers) as pool:
+            return list(pool.map(func, *zip(*jobs)))
+    return [func(*job) for job in jobs]
@@ -0,0 +1,166 @@
+"""
+Run reports: where the time and memory of a run go.
+
+A RunReport measures every stage of a run (extraction, binning, images, gifs,
+montage ...) and the slices inside them: wall time, CPU time of the process
+and of its finished worker processes, peak resident memory, frames per second
+and the bytes read and written. The report is saved as JSON after every stage,
+so an interrupted run still has one, and runs of different sizes or commits
+can be compared. Optionally every stage is also profiled with cProfile.
+
+Stages can be nested, e.g. the slices inside make_avokado_images, and are
+named by their path ('make_avokado_images/df0'). A stage without frames
+counts the frames of the stages inside it.
+
+Peak memory is the high water mark of the process (VmHWM), which is reset at
+the start of every stage where Linux allows it, otherwise it is the peak since
+the start of the process. The bytes read and written are the ones which went
+to or came from the disk (page cache hits are not counted) and do not include
+the worker processes.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import cProfile
+import platform
+import resource
+from contextlib import contextmanager
+
+def peak_rss():
+    "Peak resident memory in bytes since the last reset_peak_rss (or since the start)"
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    return maxrss(resource.RUSAGE_SELF)
+
+def reset_peak_rss():
+    "Resets the peak resident memory of the process, True if the system allows it"
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def maxrss(who):
+    "ru_maxrss of getrusage in bytes (it is in kilobytes on Linux)"
+    rss = resource.getrusage(who).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss*1024
+
+def io_bytes():
+    "Bytes (read, written) from and to the disk by this process, (None, None) if unknown"
+    try:
+        with open('/proc/self/io') as f:
+            io = dict(line.split(':') for line in f)
+        return int(io['read_bytes']), int(io['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+def children_cpu():
+    "CPU time (user + system) of all the finished child processes"
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def difference(after, before):
+    return None if after is None or before is None else after - before
+
+class RunReport:
+    """
+    Measurements of the stages of a run, saved to path (JSON) after every stage.
+    info (e.g. the number of frames and residues) is saved with them.
+    With profile (a directory) every outermost stage is profiled and its
+    statistics are dumped to profile/<name>_<stage>.prof.
+    Without a path nothing is measured, which is how the plots behave outside of run().
+    """
+
+    def __init__(self, path=None, name='run', profile=None, **info):
+        self.path, self.name, self.profile = path, name, profile
+        self.stages = []
+        self.open = [] # Stages being measured, outermost first
+        self.info = dict(info, host=socket.gethostname(), python=platform.python_version(),
+                         started=time.strftime('%Y-%m-%d %H:%M:%S'))
+        self.started = (time.perf_counter(), time.process_time(), children_cpu())
+        if path is not None and profile:
+            os.makedirs(profile, exist_ok=True)
+
+    @contextmanager
+    def stage(self, name, frames=None, **info):
+        """Measures the code in the with block as the stage name, inside the
+        stages already open. frames is the number of frames it processes.
+        """
+        if self.path is None:
+            yield
+            return
+        parent = self.open[-1] if self.open else None
+        if parent is not None: # Its peak so far, before the reset
+            parent['peak'] = max(parent['peak'], peak_rss())
+        path = parent['record']['stage'] + '/' + name if parent else name
+        record = dict(info, stage=path)
+        current = {'record': record, 'peak': 0, 'frames': 0, 'nested': False}
+        self.open.append(current)
+        profiler = self.start_profile() if parent is None and self.profile else None
+        reset = reset_peak_rss()
+        read, written = io_bytes()
+        start = (time.perf_counter(), time.process_time(), children_cpu(), maxrss(resource.RUSAGE_CHILDREN))
+        try:
+            yield
+        finally:
+            wall, cpu, children = (time.perf_counter() - start[0], time.process_time() - start[1],
+                                   children_cpu() - start[2])
+            read_after, written_after = io_bytes()
+            self.open.pop()
+            if frames is None and current['nested']:
+                frames = current['frames']
+            record.update(wall_s=round(wall, 6), cpu_s=round(cpu, 6), children_cpu_s=round(children, 6),
+                          peak_rss_bytes=max(current['peak'], peak_rss()), peak_rss_reset=reset,
+                          read_bytes=difference(read_after, read),
+                          write_bytes=difference(written_after, written),
+                          frames=frames, frames_per_s=round(frames/wall, 3) if frames and wall > 0 else None)
+            children_peak = maxrss(resource.RUSAGE_CHILDREN)
+            if children_peak > start[3]: # A worker process reached a new peak
+                record['children_peak_rss_bytes'] = children_peak
+            if profiler is not None:
+                record['profile'] = self.stop_profile(profiler, name)
+            if parent is not None:
+                parent['peak'] = max(parent['peak'], record['peak_rss_bytes'])
+                parent['frames'] += frames or 0
+                parent['nested'] = True
+            self.stages.append(record)
+            self.save()
+
+    def start_profile(self):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError: # Another profiler is already running
+            return None
+        return profiler
+
+    def stop_profile(self, profiler, name):
+        profiler.disable()
+        path = os.path.join(self.profile, '%s_%s.prof' % (self.name, name))
+        profiler.dump_stats(path)
+        return path
+
+    def total(self):
+        "Wall and CPU time since the report was opened and the peak memory of the whole run"
+        wall, cpu, children = self.started
+        return {'wall_s': round(time.perf_counter() - wall, 6),
+                'cpu_s': round(time.process_time() - cpu, 6),
+                'children_cpu_s': round(children_cpu() - children, 6),
+                'peak_rss_bytes': maxrss(resource.RUSAGE_SELF),
+                'children_peak_rss_bytes': maxrss(resource.RUSAGE_CHILDREN)}
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'run': self.name, 'info': self.info, 'total': self.total(), 'stages': self.stages}, f, indent=1)
+        os.replace(tmp, self.path)
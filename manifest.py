@@ -0,0 +1,121 @@
+"""
+Manifest of the finished work of a run, for resuming and incremental runs.
+
+The manifest (a small JSON file in the output directory) is keyed on what the
+results depend on: the identity of the topology and trajectory files (size,
+modification time and a hash of their header), the atom selection, the first
+frame used, the number of slices and the canvas and colormap. For every stage
+(angles, histograms, images, gifs ...) it records the items already done, e.g. the frame ranges
+whose angles are in the store or the slices whose histograms are in the cube.
+A run with the same key skips those items. If the key changes the manifest
+starts empty, except when the trajectory has only grown (same first frame,
+more frames): then everything recorded for the old frames is still valid.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+
+def file_identity(path, header=65536):
+    "Size, modification time and a hash of the first header bytes of the file at path"
+    st = os.stat(path)
+    with open(path, 'rb') as f:
+        digest = hashlib.sha1(f.read(header)).hexdigest()
+    return {'path': os.path.abspath(path), 'size': st.st_size, 'mtime': st.st_mtime, 'header': digest}
+
+def first_frame(universe, frame=0):
+    "Hash of the coordinates of the first frame used, which stays the same when the trajectory grows"
+    positions = universe.trajectory[frame].positions
+    return hashlib.sha1(np.ascontiguousarray(positions).tobytes()).hexdigest()
+
+def run_key(plots):
+    "Key of the manifest of RamachandranPlots or JaninPlots plots"
+    cvs = plots.cvs
+    trajectory = file_identity(plots.trajectory)
+    trajectory.update({'nframes': plots.nframes, 'first_frame': first_frame(plots.universe, plots.start)})
+    return {'topology': file_identity(plots.topology),
+            'trajectory': trajectory,
+            'selection': plots.selection,
+            'start': plots.start,
+            'engine': plots.engine,
+            'n': plots.n,
+            'canvas': {'x_range': list(cvs.x_range), 'y_range': list(cvs.y_range),
+                       'width': cvs.plot_width, 'height': cvs.plot_height},
+            'cmap': hashlib.sha1(repr(list(plots.cmap)).encode()).hexdigest()}
+
+def grown(old, new):
+    "True if the key new differs from old only by frames appended to the trajectory"
+    rest = lambda key: {k: v for k, v in key.items() if k != 'trajectory'}
+    a, b = old['trajectory'], new['trajectory']
+    return (rest(old) == rest(new) and a['path'] == b['path']
+            and a['first_frame'] == b['first_frame'] and b['nframes'] > a['nframes'])
+
+def plain(item):
+    "item as a list of plain Python values (numpy scalars converted), as stored in JSON"
+    return [x.item() if isinstance(x, np.generic) else x for x in item]
+
+class Manifest:
+    """
+    Items done in every stage of a run, saved to path after every change.
+    Without a path nothing is recorded (and nothing is ever done),
+    which is how the plots behave outside of run().
+    """
+
+    def __init__(self, path=None, key=None, reset=False):
+        self.path, self.key = path, key
+        self.stages = {}
+        self.grown_from = None # Number of frames before the trajectory grew
+        if path is None:
+            return
+        if os.path.exists(path) and not reset:
+            with open(path) as f:
+                old = json.load(f)
+            if old['key'] == key:
+                self.stages = old['stages']
+            elif grown(old['key'], key):
+                self.stages = old['stages']
+                self.grown_from = old['key']['trajectory']['nframes']
+                print('Trajectory grew from %d to %d frames' % (self.grown_from, key['trajectory']['nframes']))
+            else:
+                print('Inputs changed, starting %s again' % path)
+        self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'key': self.key, 'stages': self.stages}, f, indent=1)
+        os.replace(tmp, self.path) # A crash never leaves a half written manifest
+
+    def items(self, stage):
+        return self.stages.get(stage, [])
+
+    def done(self, stage, item):
+        return self.path is not None and plain(item) in self.items(stage)
+
+    def complete(self, stage, item):
+        "Records item (a list or tuple) of stage as done"
+        if self.path is None or self.done(stage, item):
+            return
+        self.stages.setdefault(stage, []).append(plain(item))
+        self.save()
+
+    def forget(self, *stages):
+        "Marks everything in stages to be done again"
+        for stage in stages:
+            self.stages.pop(stage, None)
+        self.save()
+
+    def missing(self, stage, start, end):
+        "Parts (start,end) of the frames start:end not covered by the ranges recorded for stage"
+        parts = []
+        for a, b in sorted(self.items(stage)):
+            if b <= start or a >= end:
+                continue
+            if a > start:
+                parts.append((start, a))
+            start = max(start, b)
+        if start < end:
+            parts.append((start, end))
+        return parts
@@ -1,44 +1,263 @@
 import os
-import pickle
-import pandas as pd
 import numpy as np
 import datashader as ds
-import ruptures as rpt
 from datashader.colors import viridis
 from MDAnalysis import Universe
-from MDAnalysis.analysis.dihedrals import Ramachandran, Janin
-from string import ascii_uppercase
-from shutil import copy
 import json
-from astropy.stats import circmean, circcorrcoef
+from concurrent.futures import ProcessPoolExecutor
+from dihedrals import DihedralKernel, CombinedKernel, compute_angles, table_residues, table_residue_group
+from anglestore import AngleStore, open_angles, write_angles, store_paths
+from histograms import HistogramEngine, HistogramCube
+from images import ANIMATIONS, annotate, blank, open_images, make_gif, chain_montage, sprite_sheet, map_jobs
+from manifest import Manifest, run_key
+from instrument import RunReport
+from residues import ResidueIndex
+from correlations import CircularCorrelation, SlidingCorrelation, correlation_map, truncated_matrix, save_correlations
 
-class RamachandranPlots:
-    def __init__(self, universe):
-        "Takes MDAnalysis Universe as a input"
+_worker_kernels = {} # Per process cache of DihedralKernels used by dihedral_angles
+
+def dihedral_angles(kind, engine, topology, trajectory, selection, start, end, store, offset=0):
+    """Calculates the dihedral angles (kind is 'ramachandran' or 'janin')
+    over the frames offset+start:offset+end of a Universe opened in the worker
+    process and writes them directly into their rows start:end of the AngleStore store.
+    Used by the worker processes, each of which has to read the trajectory
+    through its own Universe.
+    """
+    key = (kind, topology, trajectory, selection)
+    if key not in _worker_kernels:
+        u = Universe(topology, trajectory)
+        ag = u.select_atoms(selection)
+        _worker_kernels[key] = (ag, DihedralKernel(ag, kind) if engine == 'numpy' else None)
+    ag, kernel = _worker_kernels[key]
+    write_angles(store, start, compute_angles(ag, kind, engine, offset+start, offset+end, kernel=kernel))
+
+def combined_dihedral_angles(topology, trajectory, selections, start, end, stores, offset=0):
+    """Calculates Ramachandran and Janin angles together over the frames
+    offset+start:offset+end of a Universe opened in the worker process and
+    writes them into the rows start:end of the two AngleStores stores.
+    selections are the Ramachandran and the Janin atom selections.
+    """
+    key = ('combined', topology, trajectory, selections)
+    if key not in _worker_kernels:
+        u = Universe(topology, trajectory)
+        _worker_kernels[key] = (None, combined_kernel(u, *selections))
+    for store, angles in zip(stores, _worker_kernels[key][1].run(offset+start, offset+end)):
+        write_angles(store, start, angles)
+
+def combined_kernel(universe, rama_selection, janin_selection):
+    "Kernel computing Ramachandran and Janin angles in one pass over the trajectory"
+    return CombinedKernel([DihedralKernel(universe.select_atoms(rama_selection),'ramachandran'),
+                           DihedralKernel(universe.select_atoms(janin_selection),'janin')])
+
+def extract_rama_and_janin(universe, workers=1, directory=None, selection='protein', start=0, stop=None,
+                           n=10, resume=True):
+    """Reads every frame of the trajectory only once and fills both the
+    Ramachandran (phi/psi) and the Janin (chi1/chi2) tables at the same time.
+    Returns RamachandranPlots and JaninPlots (numpy engine, n slices) which
+    start from those tables instead of running their own extraction.
+    Both manifests record the frames extracted, and with resume only the
+    frames missing from either table are read.
+    """
+    rp = RamachandranPlots(universe, workers=workers, engine='numpy', directory=directory,
+                           selection=selection, start=start, stop=stop)
+    jp = JaninPlots(universe, workers=workers, engine='numpy', directory=directory,
+                    selection=selection, start=start, stop=stop)
+    for plots in (rp, jp):
+        plots.n = n
+        plots.open_manifest(resume)
+        plots.store = plots.open_store()
+    frames = rp.slices()
+    ranges = [r for i in range(len(frames)-1)
+              for r in merge_ranges(rp.manifest.missing('angles',frames[i],frames[i+1])+
+                                    jp.manifest.missing('angles',frames[i],frames[i+1]))]
+    selections = (rp.selection, jp.selection)
+    if workers > 1 and ranges:
+        k = -(-workers//len(ranges)) # Number of pieces per range
+        ranges = [r for start,end in ranges for r in split_ranges([start,end],k)]
+        stores = (rp.store.header_path, jp.store.header_path)
+        with ProcessPoolExecutor(workers) as pool:
+            jobs = [pool.submit(combined_dihedral_angles,rp.topology,rp.trajectory,
+                                selections,start,end,stores,rp.start) for start,end in ranges]
+            for (start,end),job in zip(ranges,jobs):
+                job.result()
+                rp.manifest.complete('angles',(start,end))
+                jp.manifest.complete('angles',(start,end))
+    elif ranges:
+        kernel = combined_kernel(universe,*selections)
+        for start,end in ranges:
+            rama, janin = kernel.run(rp.start+start,rp.start+end)
+            rp.store.write(start,rama)
+            jp.store.write(start,janin)
+            rp.manifest.complete('angles',(start,end))
+            jp.manifest.complete('angles',(start,end))
+    rp.concat_dataframes()
+    jp.concat_dataframes()
+    return rp, jp
+
+_worker_cubes = {} # Per process cache of the HistogramCube used by render_residues and render_sprites
+
+def worker_cube(cube_path):
+    "The HistogramCube saved at cube_path, loaded once per process (and again if it was saved since)"
+    key = (cube_path, os.path.getmtime(cube_path))
+    if key not in _worker_cubes:
+        _worker_cubes.clear()
+        _worker_cubes[key] = HistogramCube.load(cube_path)
+    return _worker_cubes[key]
+
+def render_residues(cube_path, slices, residues, paths, labels, cmap, aggregate):
+    """Shades the histograms of residues (indices into the cube) in slices (a list
+    of slice numbers), or in all slices up to each one if aggregate, of the
+    HistogramCube saved at cube_path and saves them labelled to paths (for each
+    residue a list in the order of slices). Used by the worker processes.
+    """
+    cube = worker_cube(cube_path)
+    for r, files, label in zip(residues, paths, labels):
+        files = dict(zip(slices, files))
+        for i, counts in cube.residue_slices(r, slices, aggregate):
+            img = ds.tf.shade(cube.engine.aggregate(counts), cmap=cmap)
+            annotate(img.to_pil(), label).save(files[i])
+
+def render_sprites(cube_path, residues, path, size, cmap, aggregate):
+    """Sprite sheet of residues, a list of (cube index or None for a blank,
+    serial number, label), shaded from the HistogramCube saved at cube_path:
+    one row per residue of size x size tiles, one per slice. Saved to path
+    (a PNG) with its layout in the JSON file next to it. Used by the worker processes.
+    """
+    cube = worker_cube(cube_path)
+    nslices = len(cube.frames) - 1
+    def tiles(): # Shaded one at a time, the whole sheet is never held as separate images
+        for r, n, label in residues:
+            if r is None:
+                for i in range(nslices):
+                    yield annotate(blank((cube.engine.width, cube.engine.height)), label)
+                continue
+            for i, counts in cube.residue_slices(r, cumulative=aggregate):
+                yield annotate(ds.tf.shade(cube.engine.aggregate(counts), cmap=cmap).to_pil(), label)
+    sprite_sheet(tiles(), nslices, len(residues), size).save(path)
+    layout = {'size': size, 'frames': cube.frames, 'aggregate': aggregate,
+              'residues': [{'n': n, 'label': label, 'row': k} for k, (r, n, label) in enumerate(residues)]}
+    with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+        json.dump(layout, f)
+
+def render_cube(cube, cube_path, dirs, residues, cmap, aggregate=False, workers=1, group=64,
+                todo=None, finished=None):
+    """Shades the histograms of residues, a list of (cube index, file name, label),
+    in every slice of cube into dirs (one directory for each slice).
+    With workers > 1 the slices and groups of residues are shared among a pool
+    of processes, which read the histograms from cube saved at cube_path.
+    With aggregate a process renders all slices of its residues, summing
+    them as it goes, instead of summing the earlier slices again for each one.
+    todo are the numbers of the slices to render (all by default) and
+    finished(i) is called for every slice i once its images are saved.
+    """
+    todo = list(range(len(dirs))) if todo is None else list(todo)
+    finished = finished or (lambda i: None)
+    for i in todo:
+        os.makedirs(dirs[i], exist_ok=True)
+    if workers > 1:
+        jobs = []
+        if aggregate: # Fewer jobs, one for all slices, so smaller groups to share them
+            group = max(1, min(group, -(-len(residues)//workers)))
+        for k in range(0, len(residues), group):
+            r, files, labels = zip(*residues[k:k+group])
+            for slices in ([todo] if aggregate else [[i] for i in todo]):
+                paths = [[os.path.join(dirs[i], f) for i in slices] for f in files]
+                jobs.append((cube_path, slices, r, paths, labels, cmap, aggregate))
+        map_jobs(render_residues, jobs, workers)
+        for i in todo:
+            finished(i)
+        return
+    slices = cube.cumulative() if aggregate else iter(cube)
+    for i, (d, counts) in enumerate(zip(dirs, slices)):
+        if i not in todo:
+            continue
+        for r, f, label in residues:
+            img = ds.tf.shade(cube.engine.aggregate(counts[r]), cmap=cmap)
+            annotate(img.to_pil(), label).save(os.path.join(d, f))
+        finished(i)
+        print('Finished directory %s' % d)
+
+def merge_ranges(ranges):
+    "Union of the (start,end) frame ranges as disjoint ranges in frame order"
+    merged = []
+    for start,end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0],max(merged[-1][1],end))
+        else:
+            merged.append((start,end))
+    return merged
+
+def split_ranges(frames, parts):
+    """Splits consecutive slices from frames into at least parts
+    disjoint (start,end) frame ranges, keeping them in frame order.
+    """
+    k = -(-parts//(len(frames)-1)) # Number of pieces per slice
+    ranges = []
+    for i in range(len(frames)-1):
+        edges = np.linspace(frames[i],frames[i+1],k+1).astype(int)
+        ranges += [(s,e) for s,e in zip(edges[:-1],edges[1:]) if e > s]
+    return ranges
+
+class AngularPlots:
+    """
+    What RamachandranPlots and JaninPlots have in common: the extraction of
+    the table of angles into an AngleStore, the histograms of the slices and
+    the images, animations and sprite sheets made from them. The subclasses
+    set kind (of the angles, as in dihedrals.py), prefix (of the files,
+    e.g. rama_all.json), stem (of the directories of the slices, e.g. df0),
+    the atoms, the ResidueIndex and the canvas, and name the residues of
+    every chain which get images (chains).
+    """
+    kind = prefix = stem = None
+    angles = ('x','y') # Names of the two angles of every residue
+    gifs = sprites = None # Directories of the animations and sprite sheets
+    montages = '' # Prefix of the animations of the chains e.g. A.gif
+    blanks = False # Blank images for the residues of the chains which have no angles
+
+    def __init__(self, universe, workers=1, engine='mdanalysis', directory=None, start=0, stop=None):
         self.universe = universe
-        self.nframes = universe.trajectory.n_frames
-        self.protein = universe.select_atoms('protein')
-        self.nresidues = len(self.protein.residues.resids)
-        self.nchains = len(self.protein.fragments)
-        self.res_per_chain = self.nresidues//self.nchains
-        self.resnames = self.get_resnames()
-        self.dir = os.path.abspath(os.path.dirname(self.universe.filename))
+        self.topology = universe.filename
+        self.trajectory = universe.trajectory.filename
+        self.workers = workers
+        self.engine = engine
+        self.kernel = None
+        frames = range(universe.trajectory.n_frames)[start:stop]
+        self.start = frames.start # Row 0 of the tables is this frame of the trajectory
+        self.nframes = len(frames)
+        self.dir = os.path.abspath(directory or os.path.dirname(self.universe.filename))
+        os.makedirs(self.dir, exist_ok=True)
         self.n  = 10 # Number of pieces to cut the trajectory into
         self.delta = self.nframes // self.n
-        self.cvs = ds.Canvas(plot_width=500, plot_height=500,x_range=(-180,180),y_range=(-180,180))
-        self.partialdfs = []
+        self.cmap = viridis
+        self.formats = ['gif'] # Outputs: animations ('gif', 'webp', 'apng') and/or 'sprites' (sheets per chain)
+        self.sprite_size = 100 # Tiles of the sprite sheets in pixels
+        self.cube_path = os.path.join(self.dir,'%s_cube.npz' %self.prefix) # Saved histograms of all slices
+        self.manifest = Manifest() # Records nothing until run() opens the manifest
+        self.report = RunReport() # Measures nothing until run() opens the report
+        self.store = None
 
-    def get_resnames(self):
-        return [r.resname for r in self.protein.residues]
+    @property
+    def table(self):
+        "The table of angles (self.rama or self.janin), None until it is extracted or read"
+        return getattr(self,self.prefix)
+
+    def read_table(self,file):
+        "Reads the angles from an AngleStore (zero-copy) or from an older pickle"
+        setattr(self,self.prefix,open_angles(file))
 
     def n_to_residue(self,n):
-        """Converts the serial number n (from 1 to nresidues)
+        """Converts the serial number n (from 1 to the number of all residues)
         to a string "Res Ch num" e.g. PHE B 221
         """
-        chains = list(ascii_uppercase)[:self.nchains]
-        chain = chains[(n-1)//self.res_per_chain]
-        resname = self.resnames[n-1]
-        return u"%s %s %s" %(resname, chain, n%self.res_per_chain or self.res_per_chain)
+        return self.index.label(n)
+
+    def chains(self):
+        "Chain -> serial numbers of its residues which get images"
+        raise NotImplementedError
+
+    def animations(self):
+        "Extensions of the animations among self.formats, for which the images are made"
+        return [ANIMATIONS[f] for f in self.formats if f in ANIMATIONS]
 
     def slices(self):
         "A list of frame numbers to cut the trajectory"
@@ -48,83 +267,421 @@ class RamachandranPlots:
         else: l += [m]
         return l
 
+    def slice_dirs(self,nslices=None):
+        "Directories of the images of the slices e.g. df0 ... df9"
+        return [os.path.join(self.dir,'%s%d' %(self.stem,i)) for i in range(self.n if nslices is None else nslices)]
+
     def make_partial_dataframe(self,start,end):
-        os.chdir(self.dir)
-        R = Ramachandran(self.protein,verbose=True) 
-        R.run(start,end)
-        angles = R.results['angles'].reshape(end-start,(self.nresidues-2)*2)
-        df = pd.DataFrame(angles)
-        print('Writing out rama_%d_%d.pkl' %(start,end))
-        df.to_pickle('rama_%d_%d.pkl' %(start,end))
-        self.partialdfs.append('rama_%d_%d.pkl' %(start,end))
-        del df
+        if self.engine == 'numpy' and self.kernel is None:
+            self.kernel = DihedralKernel(self.protein,self.kind)
+        angles = compute_angles(self.protein,self.kind,self.engine,self.start+start,self.start+end,kernel=self.kernel)
+        print('Writing out frames %d-%d to %s' %(start,end,self.store.data_path))
+        self.store.write(start,angles)
+        self.manifest.complete('angles',(start,end))
+
+    def create_store(self):
+        "Preallocates the float32 AngleStore (e.g. rama_all.f32) for all the frames"
+        residues = table_residues(self.protein,self.kind)
+        return AngleStore.create(os.path.join(self.dir,'%s_all' %self.prefix),self.nframes,residues,self.angles,self.kind,
+                                 chains=self.index.table_positions())
+
+    def open_manifest(self,resume=True):
+        """Opens the manifest (e.g. rama_manifest.json), which records the finished
+        work so that a run can be resumed. With resume=False everything is done again.
+        """
+        self.manifest = Manifest(os.path.join(self.dir,'%s_manifest.json' %self.prefix),run_key(self),reset=not resume)
+
+    def open_report(self,profile=False):
+        """Opens the report (e.g. rama_report.json), which gets the time, memory and i/o
+        of every stage of the run. With profile the stages are also profiled into profiles/.
+        """
+        self.report = RunReport(os.path.join(self.dir,'%s_report.json' %self.prefix),self.prefix,
+                                os.path.join(self.dir,'profiles') if profile else None,
+                                topology=self.topology,trajectory=self.trajectory,nframes=self.nframes,
+                                nresidues=self.nresidues,n=self.n,workers=self.workers,engine=self.engine)
+
+    def open_store(self):
+        """The store of a previous run if the manifest has angles in it
+        (grown in place if frames were appended to the trajectory), otherwise a new one
+        """
+        path = os.path.join(self.dir,'%s_all' %self.prefix)
+        if self.manifest.items('angles') and all(map(os.path.exists,store_paths(path))):
+            store = AngleStore(path,mode='r+')
+            if store.shape[0] < self.nframes:
+                store = store.grow(self.nframes)
+            if store.shape[0] == self.nframes:
+                return store
+        self.manifest.forget('angles')
+        return self.create_store()
 
     def make_all_dataframes(self):
+        "Extracts the angles of all frames which are not in the store yet"
+        self.store = self.open_store()
         frames = self.slices()
-        for i in range(len(frames)-1):
-           self.make_partial_dataframe(frames[i],frames[i+1]) 
-    
+        ranges = [r for i in range(len(frames)-1) for r in self.manifest.missing('angles',frames[i],frames[i+1])]
+        if self.workers > 1:
+            with self.report.stage('workers',frames=sum(end-start for start,end in ranges)):
+                self.make_parallel_dataframes(ranges)
+            return
+        for start,end in ranges:
+            with self.report.stage('%d-%d' %(start,end),frames=end-start):
+                self.make_partial_dataframe(start,end)
+
+    def make_parallel_dataframes(self,ranges):
+        """Each worker opens its own Universe, extracts the angles for a
+        disjoint part of ranges and writes them directly into its rows of the store.
+        """
+        if not ranges:
+            return
+        k = -(-self.workers//len(ranges)) # Number of pieces per range
+        ranges = [r for start,end in ranges for r in split_ranges([start,end],k)]
+        with ProcessPoolExecutor(self.workers) as pool:
+            jobs = [pool.submit(dihedral_angles,self.kind,self.engine,self.topology,self.trajectory,
+                                self.selection,start,end,self.store.header_path,self.start) for start,end in ranges]
+            for (start,end),job in zip(ranges,jobs):
+                job.result()
+                self.manifest.complete('angles',(start,end))
+
     def concat_dataframes(self):
-        df = pd.concat([pd.read_pickle(f) for f in self.partialdfs])
-        df.reset_index(inplace=True,drop=True)
-        df.astype('float32')
-        df.to_pickle('rama_all.pkl')
-        self.rama = pd.read_pickle('rama_all.pkl')
+        "Opens the store written by make_all_dataframes as the table of all angles"
+        self.read_table(self.store.header_path)
+
+    def make_images(self,aggregate=False):
+        """Bins every slice once and saves the histograms of all slices to
+        the cube (e.g. rama_cube.npz), from which render_from_cube can make the images again.
+        With aggregate the images show all frames from the start of the trajectory.
+        """
+        frames = self.slices()
+        self.cube = HistogramCube.for_engine(self.histograms,frames,len(self.index.table))
+        saved = self.saved_cube()
+        for i in range(len(frames)-1):
+            directory = self.stem + str(i)
+            j = saved.find(frames[i],frames[i+1]) if saved else None
+            if j is not None and self.manifest.done('histograms',frames[i:i+2]):
+                print('Histograms of %s already done' %directory)
+                self.cube.slices[i] = saved.slices[j]
+                continue
+            print(directory)
+            with self.report.stage(directory,frames=frames[i+1]-frames[i]):
+                angles = self.table.iloc[frames[i]:frames[i+1],:].values
+                self.cube.add(i,self.histograms.counts(angles[:,0::2],angles[:,1::2]))
+            self.cube.save(self.cube_path) # Saved slice by slice, so an interrupted run can resume
+            self.manifest.complete('histograms',frames[i:i+2])
+            print('Finished binning %s' %directory)
+        self.cube.save(self.cube_path)
+        if self.animations(): # Sprites are made straight from the cube
+            with self.report.stage('images'):
+                self.images_from_cube(self.cube,aggregate)
+
+    def saved_cube(self):
+        "Histograms saved by a previous run, if the manifest has some of them as done"
+        if self.manifest.items('histograms') and os.path.exists(self.cube_path):
+            return HistogramCube.load(self.cube_path)
+        return None
+
+    def images_from_cube(self,cube,aggregate=False,cube_path=None,resume=True):
+        """Makes the images of all slices (e.g. df0, df1 ...) from the HistogramCube cube,
+        in parallel if self.workers > 1 (the workers read cube saved at cube_path).
+        Slices which the manifest has as done are skipped if resume.
+        """
+        dirs = self.slice_dirs(len(cube.frames)-1)
+        items = [(d,cube.frames[i],cube.frames[i+1],aggregate) for i,d in enumerate(dirs)]
+        todo = [i for i,item in enumerate(items) if not (resume and self.manifest.done('images',item))]
+        if todo:
+            self.manifest.forget('gifs','montage')
+        finished = lambda i: self.manifest.complete('images',items[i])
+        residues = [(r,'%d.png' %n,self.n_to_residue(n)) for r,n in enumerate(self.index.table)]
+        render_cube(cube,cube_path or self.cube_path,dirs,residues,self.cmap,aggregate,self.workers,
+                    todo=todo,finished=finished)
+
+    def render_from_cube(self,n=None,size=None,aggregate=False):
+        """Makes the images again from the saved histograms in the cube (e.g. rama_cube.npz)
+        without touching the angles, e.g. after changing self.cmap.
+        n is a new number of slices (their edges have to be among the saved ones),
+        size a new image size in pixels (it has to divide the saved one).
+        """
+        cube = HistogramCube.load(self.cube_path)
+        cube_path = self.cube_path
+        if n is not None:
+            self.n = n
+            self.delta = self.nframes // self.n
+            cube = cube.merged(self.slices())
+        if size is not None:
+            cube = cube.resized(size,size)
+        if (n, size) != (None, None) and self.workers > 1:
+            cube_path = os.path.join(self.dir,'%s_cube_render.npz' %self.prefix) # Read by the workers
+            cube.save(cube_path)
+        self.images_from_cube(cube,aggregate,cube_path,resume=False)
+        self.manifest.forget('images','sprites') # The images no longer match the ones of the run
+
+    def create_images(self,df,d):
+        """Creates the plots of all residues from the angles in df in directory d.
+        All residues are binned at once into a count cube by the HistogramEngine.
+        """
+        angles = df.values
+        self.create_images_from_histograms(self.histograms.counts(angles[:,0::2],angles[:,1::2]),d)
+
+    def create_images_from_histograms(self,cube,d,engine=None):
+        "Shades the count cube (one histogram per residue of the table) into images in directory d"
+        engine = engine or self.histograms
+        dir_path = os.path.join(self.dir, d)
+        os.makedirs(dir_path, exist_ok=True)
+        for r,n in enumerate(self.index.table):
+            img = ds.tf.shade(engine.aggregate(cube[r]), cmap=self.cmap)
+            annotate(img.to_pil(),self.n_to_residue(n)).save(os.path.join(dir_path,'%d.png' %n))
+
+    def create_blanks(self):
+        "Creates labelled blank images for the residues of the chains which have no angles in the table"
+        if self.manifest.done('blanks',self.slices()):
+            print('Blanks already made')
+            return
+        missing = [n for v in self.chains().values() for n in v if self.index.table_position(n) is None]
+        for d in self.slice_dirs():
+            os.makedirs(d, exist_ok=True)
+            print('Making blanks in %s' % os.path.basename(d))
+            for n in missing:
+                annotate(blank((self.histograms.width,self.histograms.height)),self.n_to_residue(n)).save(os.path.join(d,'%d.png' % n))
+        self.manifest.complete('blanks',self.slices())
+
+    def create_gifs(self):
+        """Create one gif (and the other animations in self.formats) for each amino acid stacking
+        png images from the directories of the slices (e.g. df0 ... df9) i.e. times
+        """
+        todo = [ext for ext in self.animations() if not self.manifest.done('gifs',self.slices()+[ext])]
+        if not todo:
+            print('Gifs already made')
+            return
+        gifs = os.path.join(self.dir,self.gifs)
+        if not os.path.exists(gifs):
+            print('Making directory %s' %self.gifs)
+            os.mkdir(gifs)
+        dirs = self.slice_dirs()
+        jobs = [([os.path.join(d,'%d.png' %n) for d in dirs], # In order df0 ... df9
+                 [os.path.join(gifs,'%d%s' %(n,ext)) for ext in todo]) for v in self.chains().values() for n in v]
+        print('Making %d animations (%s)' %(len(jobs),' '.join(todo)))
+        map_jobs(make_gif,jobs,self.workers)
+        for ext in todo:
+            self.manifest.complete('gifs',self.slices()+[ext])
+
+    def montage(self):
+        """
+        Combine all pngs into a tile for each chain.
+        Finally combine all chain montages to a single gif (and the other animations).
+        """
+        todo = [ext for ext in self.animations() if not self.manifest.done('montage',self.slices()+[ext])]
+        if not todo:
+            print('Montage already made')
+            return
+        dirs = self.slice_dirs()
+        jobs = []
+        for c,v in self.chains().items(): # Chain -> serial numbers of its residues
+            print('Making montage of chain %s' %c)
+            pngs = [[os.path.join(d,'%d.png' %k) for k in v] for d in dirs]
+            tiles = [os.path.join(d,'%s.png' %c) for d in dirs]
+            jobs.append((c,pngs,tiles,[os.path.join(self.dir,self.montages+c+ext) for ext in todo]))
+        map_jobs(chain_montage,jobs,self.workers)
+        for ext in todo:
+            self.manifest.complete('montage',self.slices()+[ext])
+        print('All done!')
+
+    def create_sprites(self,aggregate=False):
+        """Makes one sprite sheet per chain (e.g. sprites/A.png) with a row of
+        tiles (one per slice) for every residue, shaded from the saved
+        histograms in the cube, and its layout in the JSON file next to it (A.json).
+        One file per chain instead of a png per residue and slice.
+        """
+        item = self.slices()+[self.sprite_size,aggregate]
+        if self.manifest.done('sprites',item):
+            print('Sprites already made')
+            return
+        sprites = os.path.join(self.dir,self.sprites)
+        os.makedirs(sprites,exist_ok=True)
+        jobs = []
+        for c,v in self.chains().items():
+            residues = [(self.index.table_position(n),int(n),self.n_to_residue(n)) for n in v] # None: a blank
+            jobs.append((self.cube_path,residues,os.path.join(sprites,'%s.png' %c),self.sprite_size,self.cmap,aggregate))
+        print('Making %d sprite sheets' %len(jobs))
+        map_jobs(render_sprites,jobs,self.workers)
+        self.manifest.complete('sprites',item)
+
+    def create_outputs(self):
+        "The blanks, animations and montages and/or the sprite sheets of self.formats"
+        if self.animations():
+            if self.blanks:
+                with self.report.stage('create_blanks'):
+                    self.create_blanks()
+            with self.report.stage('create_gifs'):
+                self.create_gifs()
+            with self.report.stage('montage'):
+                self.montage()
+        if 'sprites' in self.formats:
+            with self.report.stage('create_sprites'):
+                self.create_sprites()
+
+    def truncate_correlation_matrix(self,limit=0.5):
+        """Leave only rows and columns which have at least one element with corr > limit or corr < - limit,
+        not counting the diagonal elements and their immediate neighbours
+        """
+        self.pairs = self.correlation.pairs(limit,band=1)
+        self.cm = truncated_matrix(self.pairs,self.labels)
+
+class RamachandranPlots(AngularPlots):
+    kind, prefix, stem = 'ramachandran', 'rama', 'df'
+    angles = ('phi','psi')
+    gifs, sprites = 'gifs', 'sprites' # Directories of the animations and sprite sheets
+    blanks = True # The first and last residues of every segment have no phi/psi
+
+    def __init__(self, universe, workers=1, engine='mdanalysis', directory=None, selection='protein',
+                 start=0, stop=None):
+        """Takes MDAnalysis Universe as a input. selection are the atoms of the
+        protein and start:stop the frames of the trajectory used (all by default).
+        With workers > 1 the angles are extracted by a pool of processes.
+        The engine is either 'mdanalysis' (Ramachandran analysis) or 'numpy'
+        (vectorized DihedralKernel from dihedrals.py).
+        All files are written to directory, by default the one of the topology.
+        """
+        self.rama = None
+        super().__init__(universe, workers, engine, directory, start, stop)
+        self.selection = selection
+        self.protein = universe.select_atoms(self.selection)
+        self.nresidues = len(self.protein.residues.resids)
+        # Chains and labels of all residues; the table has phi/psi of all but the
+        # first and last residue of every segment, as resolved by MDAnalysis
+        self.index = ResidueIndex(self.protein,table_residue_group(self.protein,self.kind),self.angles)
+        self.nchains = self.index.nchains
+        self.resnames = self.get_resnames()
+        self.cvs = ds.Canvas(plot_width=500, plot_height=500,x_range=(-180,180),y_range=(-180,180))
+        self.histograms = HistogramEngine.from_canvas(self.cvs,dims=('Phi','Psi'))
+
+    def get_resnames(self):
+        return [r.resname for r in self.protein.residues]
+
+    def chains(self):
+        "Chain -> serial numbers of all its residues, the ones without phi/psi get blank images"
+        return self.index.chains
 
     def read_rama(self,file):
-        self.rama = pd.read_pickle(file)
-            
+        "Reads the angles from an AngleStore (zero-copy) or from an older pickle"
+        self.read_table(file)
+
     def make_avokado_images(self,aggregate=False):
+        """Bins every slice once and saves the histograms of all slices to
+        rama_cube.npz, from which render_from_cube can make the images again.
+        With aggregate the images show all frames from the start of the trajectory.
+        """
+        self.make_images(aggregate)
+
+    def create_phi_psi(self,df,n,d='df0'):
+        """Creates the phi_psi plot for residue number n during the trajectory in directory d
+        with a single Datashader aggregation (create_images does all residues at once)
+        """
+        dir_path = os.path.join(self.dir, d)
+        os.makedirs(dir_path, exist_ok=True)
+        self.save_image(self.histogram(df,n),os.path.join(dir_path,'%s.png' %(n)),self.n_to_residue(n))
+
+    def histogram(self,df,n):
+        "Datashader aggregation (counts on the canvas) of phi and psi of residue number n"
+        r = self.index.table_position(n)
+        phi_psi = df[[2*r,2*r+1]]
+        phi_psi.columns = ['Phi','Psi']
+        return self.cvs.points(phi_psi,'Phi','Psi')
+
+    def save_image(self,agg,path,label=None):
+        "Shades the aggregation agg and saves it labelled with label"
+        img = ds.tf.shade(agg, cmap=self.cmap)
+        img = img.to_pil()
+        if label:
+            annotate(img,label)
+        img.save(path)
+
+    def stream_avokado_images(self,chunk=10000,keep_angles=False,aggregate=False):
+        """Instead of making the table of all angles first, reads the trajectory
+        in chunks of frames and adds the angles of each chunk straight to the
+        phi/psi histograms of its slice, after which the chunk is dropped.
+        The images of a slice are made as soon as the slice is complete, so
+        memory depends on chunk and the number of residues, not on the number of frames.
+        With keep_angles the angles are also written to the AngleStore rama_all.f32
+        (e.g. for ruptures or correlations later).
+        """
+        if self.engine == 'numpy' and self.kernel is None:
+            self.kernel = DihedralKernel(self.protein,'ramachandran',batch=chunk)
+        if keep_angles:
+            self.store = self.create_store()
         frames = self.slices()
+        self.cube = HistogramCube.for_engine(self.histograms,frames,len(self.index.table))
+        total = None
         for i in range(len(frames)-1):
             directory = 'df' + str(i)
             print(directory)
-            if aggregate:
-                start, stop = 0, frames[i+1]
-            else:
-                start, stop = frames[i], frames[i+1]
-            dfw = self.rama.iloc[start:stop,:]
-            self.create_images(dfw,directory)
+            counts = None
+            with self.report.stage(directory,frames=frames[i+1]-frames[i]):
+                for start in range(frames[i],frames[i+1],chunk):
+                    end = min(start+chunk,frames[i+1])
+                    angles = compute_angles(self.protein,'ramachandran',self.engine,self.start+start,self.start+end,kernel=self.kernel)
+                    angles = angles.astype(np.float32) # Binned exactly as from the AngleStore
+                    if keep_angles:
+                        self.store.write(start,angles)
+                    counts = self.histograms.counts(angles[:,:,0],angles[:,:,1],counts)
+                self.cube.add(i,counts)
+            if aggregate: # Running (prefix) sum over the slices
+                total = counts if total is None else total + counts
+                counts = total
+            with self.report.stage(directory+' images'):
+                self.create_images_from_histograms(counts,directory)
             print('Finished directory %s' %directory)
-            os.chdir(self.dir)
+        self.cube.save(self.cube_path)
+        if keep_angles:
+            self.concat_dataframes()
 
-    def create_images(self, df, d):
-        dir_path = os.path.join(self.dir, d)
-        if not os.path.exists(dir_path):
-            os.makedirs(dir_path, exist_ok=True)
-        original_dir = os.getcwd()
-        try:
-            os.chdir(dir_path)
-            for n in range(2, self.nresidues):
-                self.create_phi_psi(df, n)
-        finally:
-            os.chdir(original_dir)  # Return to original directory
-
-    def create_phi_psi(self,df,n):
-        "Creates the phi_psi plot for residue number n during the trajectory"
-        phi_psi = df[[2*n-4,2*n-3]]
-        phi_psi.columns = ['Phi','Psi']
-        agg = self.cvs.points(phi_psi,'Phi','Psi')
-        img = ds.tf.shade(agg, cmap=viridis)
-        img = img.to_pil()
-        img.save('%s.png' %(n))
+    def progressive_avokado_images(self,stride=1,progressive=0,chunk=10000,aggregate=False):
+        """Makes the images from every stride-th frame only. With progressive=k
+        low resolution previews from every (k*stride)-th frame are made first,
+        within a fraction of the time, and then refined in place: the second pass
+        adds the remaining frames to the histograms of the slices saved in
+        rama_cube.npz and makes the images, gifs and montage again.
+        Every frame is read and binned only once, in chunks of chunk frames.
+        """
+        step = stride*max(progressive,1)
+        passes = [[0]] + ([[stride*j for j in range(1,progressive)]] if progressive > 1 else [])
+        if self.engine == 'numpy' and self.kernel is None:
+            self.kernel = DihedralKernel(self.protein,'ramachandran',batch=chunk)
+        frames = self.slices()
+        self.cube = HistogramCube.for_engine(self.histograms,frames,len(self.index.table))
+        for p,offsets in enumerate(passes):
+            print('Pass %d of %d: frames %s modulo %d' %(p+1,len(passes),offsets,step))
+            with self.report.stage('pass%d' %(p+1)):
+                self.progressive_pass(frames,offsets,step,chunk)
+                self.cube.save(self.cube_path)
+                with self.report.stage('images'):
+                    self.images_from_cube(self.cube,aggregate)
+                if p < len(passes)-1 and self.animations(): # Preview of the whole run
+                    with self.report.stage('create_blanks'):
+                        self.create_blanks()
+                    with self.report.stage('create_gifs'):
+                        self.create_gifs()
+                    with self.report.stage('montage'):
+                        self.montage()
 
-    def create_blanks(self):
-        os.chdir(self.dir)
-        n = self.nresidues
-        os.system('convert -size 500x500 xc:white 1.png')
-        os.system('convert -size 500x500 xc:white %d.png' % n)
-        for i in range(self.n):
-            dir_name = 'df%d' % i
-            dir_path = os.path.join(self.dir, dir_name)
-            if not os.path.exists(dir_path):
-                os.makedirs(dir_path, exist_ok=True)
-            print('Copying blanks to %s' % dir_name)
-            copy('1.png', os.path.join(dir_path, '1.png'))
-            copy('%d.png' % n, os.path.join(dir_path, '%d.png' % n))
+    def progressive_pass(self,frames,offsets,step,chunk):
+        "Adds the frames with the given offsets modulo step to the histograms of every slice"
+        for i in range(len(frames)-1):
+            counts = self.cube.dense(i) if i in self.cube.slices else None
+            firsts = [frames[i] + (offset - frames[i]) % step for offset in offsets] # First frames of the slice
+            with self.report.stage('df%d' %i,frames=sum(len(range(first,frames[i+1],step)) for first in firsts)):
+                for first in firsts:
+                    for start in range(first,frames[i+1],chunk*step):
+                        end = min(start+chunk*step,frames[i+1])
+                        angles = compute_angles(self.protein,'ramachandran',self.engine,self.start+start,self.start+end,
+                                                kernel=self.kernel,step=step)
+                        angles = angles.astype(np.float32) # Binned exactly as from the AngleStore
+                        counts = self.histograms.counts(angles[:,:,0],angles[:,:,1],counts)
+                self.cube.add(i,counts if counts is not None else self.histograms.empty(len(self.index.table)))
+            print('Finished binning df%d' %i)
 
     def annotate_images(self):
-        original_dir = os.getcwd()
+        """Labels the images in df0 ... with the residue names.
+        Images made by make_avokado_images and create_blanks are already labelled.
+        """
         for i in range(self.n):
             dir_name = 'df%d' % i
             dir_path = os.path.join(self.dir, dir_name)
@@ -132,76 +689,99 @@ class RamachandranPlots:
                 print(f"Skipping {dir_name} (not found).")
                 continue
             print('Adding labels in dir: %s' % dir_name)
-            try:
-                os.chdir(dir_path)
-                os.system("mogrify -gravity South -annotate 0 '%t' -pointsize 50 *.png")
-            finally:
-                os.chdir(original_dir)  # Always return to original directory
+            for n in range(1, self.nresidues+1):
+                path = os.path.join(dir_path, '%d.png' % n)
+                if os.path.exists(path):
+                    annotate(open_images([path])[0],self.n_to_residue(n)).save(path)
 
-    def create_gifs(self):
-        """Create one gif for each amino acid stacking
-        png images from directores df0 ... df9 i.e. times
+    def circular_correlation_matrix(self,chunk=2048,block=512):
+        """Circular correlation coefficients between all phi and psi angles,
+        with the circular mean of each angle, using the same CircularCorrelation
+        engine as JaninPlots (the dense matrix is never made).
+        Unlike RupturePlots.remove_spikes the angles need no unwrapping.
         """
-        if not os.path.exists('gifs'):
-            print('Making directory gifs')
-            os.mkdir('gifs')
-        for i in range(1,self.nresidues+1):
-            print('Making gif: %d' %i)  
-            #TODO check if the command below respects the order df0 ... df9 (shell expends this)
-            #                                  originally this was ./df{0..9}/
-            command = "convert -dispose previous -delay 10 -loop 0 ./df*/%d.png gifs/%d.gif" %(i,i)
-            os.system(command)
-        os.chdir(self.dir) 
-    
-    def montage(self):
+        self.correlation = CircularCorrelation(self.rama,chunk,block)
+        self.labels = [(self.n_to_residue(n),angle) for n in self.index.table for angle in ('phi','psi')]
+
+    def extract_correlations(self,limit=0.5):
+        "Strong correlations {('PHE A 12','phi'): {('GLY A 40','psi'): r ...} ...} saved to rama_corr.pkl and .json"
+        self.corr = correlation_map(self.pairs,self.labels)
+        save_correlations(self.corr,os.path.join(self.dir,'rama_corr.pkl'))
+
+    def sliding_correlations(self,width=1,limit=0.5,chunk=2048,block=512):
+        """Strong correlations in windows of width consecutive slices (see slices()),
+        sliding by one slice, as {(start,end): {('PHE A 12','phi'): {...}}} saved
+        to rama_window_corr.pkl and .json. The whole table is read only
+        once per block of rows of the matrix, whatever the number of windows.
         """
-        Combine all pngs into a tile for each chain.
-        Finally combine all chain montages to a single gif.
+        labels = [(self.n_to_residue(n),angle) for n in self.index.table for angle in ('phi','psi')]
+        sliding = SlidingCorrelation(self.rama,self.slices(),width,chunk,block)
+        self.window_corr = {w: correlation_map(p,labels) for w,p in zip(sliding.windows,sliding.pairs(limit,band=1))}
+        save_correlations(self.window_corr,os.path.join(self.dir,'rama_window_corr.pkl'))
+
+    def run(self,stream=False,chunk=10000,keep_angles=False,resume=True,stride=1,progressive=0,profile=False):
+        """Makes all MDavocado plots. With stream=True the angles are never held
+        in memory all at once (see stream_avokado_images).
+        With resume the work recorded in rama_manifest.json by an earlier
+        (interrupted) run on the same inputs is not done again, and only new
+        frames are extracted if the trajectory has grown.
+        stride > 1 uses only every stride-th frame, progressive=k makes previews
+        from every k-th of those first (see progressive_avokado_images).
+        Streaming, strided and progressive runs always start again.
+        The time, memory and i/o of every stage are saved to rama_report.json,
+        with profile also their cProfile statistics to profiles/.
         """
-        chns = list(ascii_uppercase[:self.nchains]) # ['A','B','C'...,'F']
-        N = self.res_per_chain 
-        chains = dict(zip(chns,[(N*i+1,N*(i+1)) for i in range(self.nchains)]))
-        for i in range(self.n):
-            print('Making montage in dir: df%d' %i) 
-            os.chdir('df%d' %i)
-            for c,v in chains.items():
-                pnglist = ' '.join([str(i)+'.png' for i in range(v[0],v[1])])
-                os.system("montage -geometry 100x100 %s %s.png" %(pnglist,c))
-                os.system("mogrify -gravity SouthEast -annotate 0 '%s' -pointsize 70 %s.png" % (c,c))
-            os.chdir(self.dir) 
-        for c in chns:
-            flist = ' '.join(['./df'+str(i)+'/%s.png' %c for i in range(self.n)])
-            os.system("convert -dispose previous -delay 10 -loop 0 %s %s.gif" % (flist,c))
-        print('All done!')
-    
-    def run(self):
-        self.make_all_dataframes()
-        self.concat_dataframes()
-        self.make_avokado_images()
-        self.create_blanks()
-        self.annotate_images()
-        self.create_gifs()
-        self.montage()
-
-class JaninPlots:
-    def __init__(self, universe):
-        "Takes MDAnalysis Universe as a input"
-        self.universe = universe
-        self.nframes = universe.trajectory.n_frames
-        self.protein = universe.select_atoms('protein and not resname ALA CYS* GLY PRO SER THR VAL')
-        self.all_residues= universe.select_atoms('protein')
-        self.resids = list(self.protein.residues.resids)
+        partial = stream or stride > 1 or progressive > 1
+        self.open_manifest(resume and not partial)
+        if partial: # Nothing of these runs is recorded as done for a full run
+            self.manifest = Manifest()
+        self.open_report(profile)
+        if stride > 1 or progressive > 1:
+            with self.report.stage('progressive_avokado_images'):
+                self.progressive_avokado_images(stride,progressive,chunk)
+        elif stream:
+            with self.report.stage('stream_avokado_images'):
+                self.stream_avokado_images(chunk,keep_angles)
+        else:
+            if self.rama is None: # Not precomputed, e.g. by extract_rama_and_janin
+                with self.report.stage('make_all_dataframes'):
+                    self.make_all_dataframes()
+                with self.report.stage('concat_dataframes'):
+                    self.concat_dataframes()
+            with self.report.stage('make_avokado_images'):
+                self.make_avokado_images()
+        self.create_outputs()
+
+class JaninPlots(AngularPlots):
+    kind, prefix, stem = 'janin', 'janin', 'janin'
+    angles = ('chi1','chi2')
+    gifs, sprites = 'janin_gifs', 'janin_sprites' # Directories of the animations and sprite sheets
+    montages = 'janin_' # janin_A.gif ... next to A.gif ... of the Ramachandran plots
+
+    def __init__(self, universe, workers=1, engine='mdanalysis', directory=None, selection='protein',
+                 start=0, stop=None):
+        """Takes MDAnalysis Universe as a input. selection are the atoms of the
+        protein and start:stop the frames of the trajectory used (all by default).
+        With workers > 1 the angles are extracted by a pool of processes.
+        The engine is either 'mdanalysis' (Janin analysis) or 'numpy'
+        (vectorized DihedralKernel from dihedrals.py).
+        All files are written to directory, by default the one of the topology.
+        """
+        self.janin = None
+        super().__init__(universe, workers, engine, directory, start, stop)
+        protein = selection if selection == 'protein' else '(%s)' % selection
+        self.selection = protein + ' and not resname ALA CYS* GLY PRO SER THR VAL'
+        self.protein = universe.select_atoms(self.selection)
+        self.all_residues= universe.select_atoms(selection)
+        # Chains and labels of all residues, the table has chi1/chi2 of the selected ones
+        self.index = ResidueIndex(self.all_residues,table_residue_group(self.protein,self.kind),self.angles)
+        self.resids = [int(n) for n in self.index.table] # Serial numbers among all residues, naming the images
         self.nresidues = len(self.protein.residues.resids)
-        self.nchains = len(self.protein.fragments)
-        self.res_per_chain = self.nresidues//self.nchains
+        self.nchains = self.index.nchains
         self.resnames = self.get_resnames()
         self.all_resnames = self.get_all_resnames()
-        self.num_res_per_chain_all = len(self.all_resnames)//self.nchains
-        self.dir = os.path.dirname(self.universe.filename)
-        self.n  = 10 # Number of pieces to cut the trajectory into
-        self.delta = self.nframes // self.n
         self.cvs = ds.Canvas(plot_width=500, plot_height=500,x_range=(0,360),y_range=(0,360))
-        self.partialdfs = []
+        self.histograms = HistogramEngine.from_canvas(self.cvs,dims=('Chi1','Chi2'))
 
     def get_resnames(self):
         return [r.resname for r in self.protein.residues]
@@ -209,184 +789,81 @@ class JaninPlots:
     def get_all_resnames(self):
         return [r.resname for r in self.all_residues.residues]
 
-    def n_to_residue(self,n):
-        """Converts the serial number n (from 1 to nresidues)
-        to a string "Res Ch num" e.g. PHE B 221
-        """
-        chains = list(ascii_uppercase)[:self.nchains]
-        chain = chains[(n-1)//self.num_res_per_chain_all]
-        resname = self.all_resnames[n-1]
-        return u"%s %s %s" %(resname, chain, n%self.num_res_per_chain_all or self.num_res_per_chain_all)
-
-    def slices(self):
-        "A list of frame numbers to cut the trajectory"
-        m, n = self.nframes, self.n
-        l = list(range(0,m,m//n))
-        if m%n: l[-1] = m
-        else: l += [m]
-        return l
-
-    def make_partial_dataframe(self,start,end):
-        os.chdir(self.dir)
-        J = Janin(self.protein,verbose=True) 
-        J.run(start,end)
-        angles = J.results['angles'].reshape(end-start,self.nresidues*2)
-        df = pd.DataFrame(angles)
-        print('Writing out janin_%d_%d.pkl' %(start,end))
-        df.to_pickle('janin_%d_%d.pkl' %(start,end))
-        self.partialdfs.append('janin_%d_%d.pkl' %(start,end))
-        del df
-
-    def make_all_dataframes(self):
-        frames = self.slices()
-        for i in range(len(frames)-1):
-           self.make_partial_dataframe(frames[i],frames[i+1]) 
-    
-    def concat_dataframes(self):
-        df = pd.concat([pd.read_pickle(f) for f in self.partialdfs])
-        df.reset_index(inplace=True,drop=True)
-        df.astype('float32')
-        df.to_pickle('janin_all.pkl')
-        self.janin = pd.read_pickle('janin_all.pkl')
+    def chains(self):
+        "Chain -> serial numbers of its residues which have chi1/chi2"
+        return self.index.table_chains()
 
     def read_janin(self,file):
-        self.janin = pd.read_pickle(file)
-            
+        "Reads the angles from an AngleStore (zero-copy) or from an older pickle"
+        self.read_table(file)
+
     def make_janin_images(self,aggregate=False):
-        frames = self.slices()
-        for i in range(len(frames)-1):
-            directory = 'janin' + str(i)
-            print(directory)
-            if aggregate:
-                start, stop = 0, frames[i+1]
-            else:
-                start, stop = frames[i], frames[i+1]
-            dfw = self.janin.iloc[start:stop,:]
-            self.create_images(dfw,directory)
-            print('Finished directory %s' %directory)
-            os.chdir(self.dir)
+        """Bins every slice once and saves the histograms of all slices to
+        janin_cube.npz, from which render_from_cube can make the images again.
+        With aggregate the images show all frames from the start of the trajectory.
+        """
+        self.make_images(aggregate)
 
-    def create_images(self,df,d):
-        if not os.path.exists(d):
-           os.mkdir(d)
-        os.chdir(d)
-        for n in self.resids:
-           self.create_chi1_chi2(df,n)
-
-    def create_chi1_chi2(self,df,n):
-        "Creates the chi1_chi2 plot for residue number n during the trajectory"
-        nn = self.resids.index(n) + 1
-        phi_psi = df[[2*nn-2,2*nn-1]]
+    def create_chi1_chi2(self,df,n,d='janin0'):
+        """Creates the chi1_chi2 plot for residue number n during the trajectory in directory d
+        with a single Datashader aggregation (create_images does all residues at once)
+        """
+        nn = self.index.table_position(n)
+        phi_psi = df[[2*nn,2*nn+1]]
         phi_psi.columns = ['Chi1','Chi2']
         agg = self.cvs.points(phi_psi,'Chi1','Chi2')
         img = ds.tf.shade(agg, cmap=viridis)
-        img = img.to_pil()
-        img.save('%s.png' %(n))
+        dir_path = os.path.join(self.dir, d)
+        os.makedirs(dir_path, exist_ok=True)
+        img.to_pil().save(os.path.join(dir_path,'%s.png' %(n)))
 
     def create_blanks(self):
-        """Create two blank images for the first and last amino acid
-        This relies on convert command from ImageMagick to be installed.
-        """
-        #FIXME: Could be implemented using PIL in pure Python.
-        os.chdir(self.dir)
+        "Create two labelled blank images for the first and last amino acid"
         n = self.nresidues
-        os.system('convert -size 500x500 xc:white 1.png')
-        os.system('convert -size 500x500 xc:white %d.png' % n)
-        for i in self.resids:
-            print('Copying blanks to janin%d' %i)           
-            copy('1.png','janin%d/1.png'%i) 
-            copy('%d.png' %n,'janin%d/%d.png'%(i,n)) 
+        for i in range(self.n):
+            dir_path = os.path.join(self.dir,'janin%d' %i)
+            os.makedirs(dir_path, exist_ok=True)
+            print('Making blanks in janin%d' %i)           
+            for j in (1, n):
+                annotate(blank((self.histograms.width,self.histograms.height)),self.n_to_residue(j)).save(os.path.join(dir_path,'%d.png' %j))
 
     def annotate_images(self):
-        "Annotate all images with their file numbers"
-        #TODO: Could be implemented using PIL in pure Python.
+        """Annotate all images with their residue names.
+        Images made by make_janin_images are already labelled.
+        """
         for i in range(self.n):
             print('Adding labels in dir: janin%d' %i) 
-            os.chdir('janin%d' %i)
+            dir_path = os.path.join(self.dir,'janin%d' %i)
             for j in self.resids:
-                text = self.n_to_residue(j)
-                os.system("mogrify -gravity South -annotate 0 '%s' -pointsize 50 %d.png" %(text,j))
-            os.chdir(self.dir) 
-
-    def create_gifs(self):
-        """Create one gif for each amino acid stacking
-        png images from directores df0 ... df9 i.e. times
-        """
-        if not os.path.exists('janin_gifs'):
-            print('Making directory janin_gifs')
-            os.mkdir('janin_gifs')
-        for i in self.resids:
-            print('Making gif: %d' %i)  
-            #TODO check if the command below respects the order df0 ... df9 (shell expends this)
-            #                                  originally this was ./df{0..9}/
-            command = "convert -dispose previous -delay 10 -loop 0 ./janin*/%d.png janin_gifs/%d.gif" %(i,i)
-            os.system(command)
-        os.chdir(self.dir) 
-    
-    def montage(self):
-        """
-        Combine all pngs into a tile for each chain.
-        Finally combine all chain montages to a single gif.
-        """
-        chns = list(ascii_uppercase[:self.nchains]) # ['A','B','C'...,'F']
-        N = self.res_per_chain 
-        chains = dict(zip(chns,[self.resids[N*i:N*(i+1)] for i in range(self.nchains)]))
-        for i in range(self.n):
-            print('Making montage in dir: janin%d' %i) 
-            os.chdir('janin%d' %i)
-            for c,v in chains.items():
-                pnglist = ' '.join([str(i)+'.png' for i in v])
-                os.system("montage -geometry 100x100 %s %s.png" %(pnglist,c))
-                os.system("mogrify -gravity SouthEast -annotate 0 '%s' -pointsize 70 %s.png" % (c,c))
-            os.chdir(self.dir) 
-        for c in chns:
-            flist = ' '.join(['./janin'+str(i)+'/%s.png' %c for i in range(self.n)])
-            os.system("convert -dispose previous -delay 10 -loop 0 %s %s.gif" % (flist,c))
-        print('All done!')
+                path = os.path.join(dir_path,'%d.png' %j)
+                annotate(open_images([path])[0],self.n_to_residue(j)).save(path)
 
-    def circular_correlation_matrix(self): 
-        """After much work finally this function correctly calculates
-        correlation coefficient between Ramachandran angles without 
-        any need for removig spikes first, it uses original angles
-        coming from MDanalysis.
-        Uses this formula:
+    def circular_correlation_matrix(self,chunk=2048,block=512):
+        """Circular correlation coefficients between all chi1 and chi2 angles,
+        with the circular mean of each angle, using this formula:
         https://docs.astropy.org/en/stable/api/astropy.stats.circcorrcoef.html
-        Also cleverly uses numpy broadcasting to calculate fast!
+        The CircularCorrelation engine reads chunk frames at a time and builds
+        block rows of the matrix at a time, so the dense matrix is never made;
+        truncate_correlation_matrix keeps only the strong correlations.
         """
-        l = []
-        for i in self.resids:
-            l += [2*i-2,2*i-1]
-        self.janin.columns = l
-        janin = np.radians(self.janin)
-        cmean = circmean(janin)
-        sinr = np.sin(janin - cmean)
-        numerator = np.matmul(sinr.T,np.asarray(sinr))
-        sinr2 = np.sum(np.sin(janin - cmean)**2)
-        # denominator is np.sqrt od sin2_r_minus_mean[i] * sin2_r_minus_mean[j]
-        # we have to get the matrix Aij from array Ai such that Aij = Ai x Aj.
-        # Numpy outer product to the rescue:
-        denominator = np.sqrt(np.outer(sinr2,sinr2))
-        self.cm = numerator/denominator
-        self.cm.columns = l
-
-    def truncate_correlation_matrix(self,limit=0.5):
-        "Leave only rows and columns which have at least one element with corr > limit or corr < - limit"
-        # First set diagonal elements to 0 and the immediate neighbours 
-        n = self.cm.shape[0]
-        a = np.diag(np.ones(n-1),k=1) + np.diag(np.ones(n)) + np.diag(np.ones(n-1),k=-1) == True
-        self.cm.mask(a,0,inplace=True)
-        self.cm = self.cm[abs(self.cm)>limit]
-        indices = self.cm.any(axis=0) 
-        self.cm = self.cm.loc[indices,indices]
+        self.correlation = CircularCorrelation(self.janin,chunk,block)
+        self.labels = [2*i-2+k for i in self.resids for k in (0,1)]
 
     def extract_correlations(self,limit=0.5):
-        self.corr = {}
-        cm_t = self.cm
-        cm_t.columns= list(map(self.num_to_res_num,cm_t.columns))
-        cm_t.index = list(map(self.num_to_res_num,cm_t.index))
-        for c in cm_t.columns:
-            self.corr[c] = dict(cm_t[cm_t[c].notnull()][c])
-        pickle.dump(self.corr,open(os.path.join(self.dir,'janin_corr.pkl'),'wb'))
+        "Strong correlations {(resid,'chi1'): {(resid,'chi2'): r ...} ...} saved to janin_corr.pkl and .json"
+        self.corr = correlation_map(self.pairs,list(map(self.num_to_res_num,self.labels)))
+        save_correlations(self.corr,os.path.join(self.dir,'janin_corr.pkl'))
+
+    def sliding_correlations(self,width=1,limit=0.5,chunk=2048,block=512):
+        """Strong correlations in windows of width consecutive slices (see slices()),
+        sliding by one slice, as {(start,end): {(resid,'chi1'): {...}}} saved
+        to janin_window_corr.pkl and .json. The whole table is read only
+        once per block of rows of the matrix, whatever the number of windows.
+        """
+        labels = [(i,angle) for i in self.resids for angle in ('chi1','chi2')]
+        sliding = SlidingCorrelation(self.janin,self.slices(),width,chunk,block)
+        self.window_corr = {w: correlation_map(p,labels) for w,p in zip(sliding.windows,sliding.pairs(limit,band=1))}
+        save_correlations(self.window_corr,os.path.join(self.dir,'janin_window_corr.pkl'))
 
     def num_to_res_num(self,i):
         chi1_chi2 = ('chi1','chi2')[i%2]
@@ -396,11 +873,19 @@ class JaninPlots:
             n = (i+1)/2
         return int(n), chi1_chi2
 
-    def run(self):
-        self.make_all_dataframes()
-        self.concat_dataframes()
-        self.make_janin_images()
-        #self.create_blanks()
-        self.annotate_images()
-        self.create_gifs()
-        self.montage()
+    def run(self,resume=True,profile=False):
+        """Makes all Janin plots. With resume the work recorded in
+        janin_manifest.json by an earlier run on the same inputs is skipped.
+        The time, memory and i/o of every stage are saved to janin_report.json,
+        with profile also their cProfile statistics to profiles/.
+        """
+        self.open_manifest(resume)
+        self.open_report(profile)
+        if self.janin is None: # Not precomputed, e.g. by extract_rama_and_janin
+            with self.report.stage('make_all_dataframes'):
+                self.make_all_dataframes()
+            with self.report.stage('concat_dataframes'):
+                self.concat_dataframes()
+        with self.report.stage('make_janin_images'):
+            self.make_janin_images()
+        self.create_outputs()
@@ -0,0 +1,107 @@
+"""
+Index of the residues of a protein, built once from its fragments (chains).
+
+Residues are numbered serially from 1 through all the chains (n), as in the
+names of the images (n.png), and labelled with their name, chain and number in
+the chain e.g. PHE B 221. Chains may have any number of residues and are named
+A ... Z, AA, AB ... in their order in the topology. Every lookup (label, chain,
+column of the table of angles) is a precomputed array or dictionary access.
+The chains of the residues in the table are saved in the header of its
+AngleStore, so that the server and ruptures (which have no Universe) name and
+group the residues in the same way.
+"""
+import numpy as np
+
+def store_residues(header):
+    """(chain, label) of the residues in the table of an AngleStore, from the
+    chains in its header. Older stores have only the segments, which then stand
+    for the chains and are labelled with the resid instead of the number in the chain.
+    """
+    residues = header['residues']
+    if 'chains' in header:
+        return [(chain, '%s %s %d' % (resname, chain, position))
+                for (segid, resid, resname), (chain, position, *n) in zip(residues, header['chains'])]
+    return [(segid or 'A', '%s %s %d' % (resname, segid, resid)) for segid, resid, resname in residues]
+
+def store_serials(header):
+    """Serial numbers n of the residues in the table of an AngleStore, as in the
+    names of the images. Older stores are taken to have all residues but the first
+    and the last, numbered 2, 3 ... as the Ramachandran table of a single chain.
+    """
+    chains = header.get('chains')
+    if chains and len(chains[0]) > 2:
+        return [int(c[2]) for c in chains]
+    return list(range(2, len(header['residues']) + 2))
+
+def chain_name(i):
+    "Name of the i-th chain (from 0): A ... Z, AA ... AZ, BA ... like spreadsheet columns"
+    name = ''
+    i += 1
+    while i:
+        i, k = divmod(i - 1, 26)
+        name = chr(ord('A') + k) + name
+    return name
+
+class ResidueIndex:
+    """
+    Chains, names and numbers of the residues of atomgroup.
+    table are the residues (a ResidueGroup, all of them by default) in the
+    table of angles, two columns each named by angles, in the order of the table.
+    """
+
+    def __init__(self, atomgroup, table=None, angles=('phi','psi')):
+        residues = atomgroup.residues
+        self.nresidues = len(residues)
+        self.resids = residues.resids
+        self.resnames = residues.resnames
+        self.angles = angles
+        # Chains numbered in the order of their first residue
+        fragments = np.array([r.atoms[0].fragindex for r in residues])
+        _, first, inverse = np.unique(fragments, return_index=True, return_inverse=True)
+        self.chain = np.argsort(np.argsort(first))[inverse.reshape(-1)] # Chain (from 0) of every residue
+        self.nchains = len(first)
+        self.chain_names = [chain_name(c) for c in range(self.nchains)]
+        self.position = np.zeros(self.nresidues, dtype=int) # Number of every residue in its chain (from 1)
+        self.chains = {} # Chain name -> serial numbers of its residues
+        for c, name in enumerate(self.chain_names):
+            members = np.flatnonzero(self.chain == c)
+            self.position[members] = np.arange(1, len(members) + 1)
+            self.chains[name] = members + 1
+        self.labels = ['%s %s %d' % (resname, self.chain_names[c], p)
+                       for resname, c, p in zip(self.resnames, self.chain, self.position)]
+        self.serials = dict(zip(residues.resindices.tolist(), range(1, self.nresidues + 1))) # resindex -> n
+        self.table = np.array(self.serial(residues if table is None else table), dtype=int)
+        self.rows = np.full(self.nresidues + 1, -1) # Serial number -> residue in the table (-1 if not there)
+        self.rows[self.table] = np.arange(len(self.table))
+
+    def serial(self, residues):
+        "Serial numbers of residues (a ResidueGroup)"
+        return [self.serials[i] for i in residues.resindices.tolist()]
+
+    def label(self, n):
+        "Name, chain and number in the chain of residue n e.g. PHE B 221"
+        return self.labels[n-1]
+
+    def table_position(self, n):
+        "Number (from 0) of residue n in the table, None if it has no angles"
+        r = self.rows[n]
+        return None if r < 0 else int(r)
+
+    def column(self, j):
+        "(chain, resid, resname, angle) of the column j of the table"
+        n = self.table[j//2]
+        return (self.chain_names[self.chain[n-1]], int(self.resids[n-1]), str(self.resnames[n-1]),
+                self.angles[j % 2])
+
+    def table_positions(self):
+        """(chain name, number in the chain, serial number) of the residues
+        in the table, in its order, for the AngleStore header
+        """
+        return [(self.chain_names[self.chain[n-1]], int(self.position[n-1]), int(n)) for n in self.table]
+
+    def table_chains(self):
+        "Chain name -> serial numbers of its residues in the table, for the chains which have any"
+        chains = {}
+        for n in self.table:
+            chains.setdefault(self.chain_names[self.chain[n-1]], []).append(int(n))
+        return chains
@@ -3,6 +3,23 @@ import pickle
 import pandas as pd
 import numpy as np
 import ruptures as rpt
+from concurrent.futures import ProcessPoolExecutor
+from anglestore import AngleStore, open_angles, unwrap_angles, unwrap_store
+from residues import store_residues, store_serials
+
+_worker_plots = {} # Per process cache of the RupturePlots used by detect_change_points
+
+def detect_change_points(file, residues, skip, width, model, penalty):
+    """Change points of residues (numbers n) from the angles in file.
+    Used by the worker processes, each of which opens the file only once
+    (an AngleStore is memory mapped, so all workers share the same pages).
+    """
+    if file not in _worker_plots:
+        _worker_plots.clear()
+        _worker_plots[file] = RupturePlots(file)
+    rup = _worker_plots[file]
+    rup.skip, rup.width, rup.model, rup.penalty = skip, width, model, penalty
+    return {n: rup.detect(n)[1] for n in residues}
 
 class RupturePlots:
     """
@@ -10,10 +27,24 @@ class RupturePlots:
     angles time series. Uses ruptures library.
     """
 
-    def __init__(self,file):
-        "Reads pickled Pandas DataFrame file with Ramachandran angles"
-        self.rama = pd.read_pickle(file)
+    def __init__(self,file,workers=1):
+        """Reads Ramachandran angles from an AngleStore (memory mapped, not copied)
+        or from a pickled Pandas DataFrame file.
+        With workers > 1 the change points are detected by a pool of processes.
+        """
+        self.file = file
+        self.workers = workers
+        self.rama = open_angles(file)
         self.nframes = self.rama.shape[0]
+        if file.endswith('.pkl'):
+            self.residues = list(range(2,self.rama.shape[1]//2+2)) # Numbers n of the residues in the table
+            self.names = None
+        else:
+            header = AngleStore(file).header
+            self.residues = store_serials(header)
+            self.names = store_residues(header) # (chain, label)
+        self.columns = {n: j for j, n in enumerate(self.residues)} # Residue n -> its number in the table
+        self.sampled = None
         self.skip = 100
         self.penalty = 1e4
         self.width = 100
@@ -23,8 +54,18 @@ class RupturePlots:
 
     def phi_psi_for_n(self,n):
         "Returns column with phi and psi for a given amino acid number"
-        angles = self.rama.iloc[:self.nframes:self.skip,2*n-4:2*n-2]
+        if self.sampled is None or self.sampled[0] != (self.nframes,self.skip):
+            # Every skip-th frame of all residues, read from the table only once
+            self.sampled = ((self.nframes,self.skip), self.rama.iloc[:self.nframes:self.skip])
+        j = self.columns[n]
+        angles = self.sampled[1].iloc[:,2*j:2*j+2]
         return angles
+
+    def residue_name(self,n):
+        "Residue name, chain and number in the chain of residue n from the header of the store e.g. PHE A 221"
+        if self.names is None:
+            return str(n)
+        return self.names[self.columns[n]][1]
     
     def detect(self,n):
         "Detects the change points"
@@ -35,27 +76,49 @@ class RupturePlots:
         result = algo.predict(pen=self.penalty)
         return angles, result
 
-    def remove_spikes(self):
-        d = self.rama.diff()
-        d[d>180]-= 360
-        d[d<-180]+= 360
-        d.iloc[0,:] = self.rama.iloc[0,:]
-        d = d.cumsum()
-        # This code has the consequence of blowing angles for some residues
-        # which leads to nonsense correlations latter and also to false breakpoints
-        # As a remedy the final Ramachandran is cut mod 360, so that it can not exceed
-        # +360 or go below -360. For many angles it will not change a thing but for some 
-        # it will mean a lot of difference, for sure for terminal residues between chains
-        # FIXME
-        # It seems that this line below only worsens the stuff for some residues like this:
-        # https://alokomp.irb.hr/md/correlations_circular/1714/1325
-        # https://alokomp.irb.hr/md/correlations_circular/1697/1184
-        d = d%(np.sign(d)*360)
-        pickle.dump(d, open('rama_all_no_spikes.pkl','wb'))
+    def remove_spikes(self,path='rama_all_no_spikes.pkl',mode='legacy',chunk=10000):
+        """Removes the spikes (jumps by 360 degrees) of the angles chunk frames
+        at a time with unwrap_angles, writing them to the AngleStore path (.json)
+        or for a table from a pickle to the pickle path (.pkl).
+        The default mode='legacy' cuts the unwrapped angles with fmod, so that they
+        can not exceed +360 or go below -360, as before. This blows up angles of
+        some residues, like terminal residues between chains, which leads to
+        nonsense correlations and false breakpoints, e.g.
+        https://alokomp.irb.hr/md/correlations_circular/1714/1325
+        https://alokomp.irb.hr/md/correlations_circular/1697/1184
+        mode='unwrap' keeps the continuous angles and mode='centered' wraps
+        each angle around its circular mean instead.
+        """
+        if not path.endswith('.pkl'):
+            return unwrap_store(self.file,path,mode,chunk)
+        d = self.rama.to_numpy(dtype=np.float64,copy=True)
+        unwrap_angles(d,d,mode,chunk)
+        pickle.dump(pd.DataFrame(d,index=self.rama.index,columns=self.rama.columns), open(path,'wb'))
+
+    def compute_change_points(self,residues=None):
+        """Detects the change points of residues (all by default) without any plotting.
+        With workers > 1 the residues are split among a pool of processes which
+        read the angles from the file themselves, so no table is pickled to them.
+        """
+        residues = list(residues or self.residues)
+        if self.workers > 1:
+            groups = [list(g) for g in np.array_split(residues,4*self.workers) if len(g)]
+            with ProcessPoolExecutor(self.workers) as pool:
+                jobs = [pool.submit(detect_change_points,self.file,g,self.skip,self.width,self.model,self.penalty)
+                        for g in groups]
+                for job in jobs:
+                    self.change_points.update(job.result())
+        else:
+            for n in residues:
+                self.change_points[n] = self.detect(n)[1]
+        return self.change_points
 
-    def save_png(self,n):
-        angles, result = self.detect(n)
-        self.change_points[n] = result
+    def save_png(self,n,directory='.'):
+        "Plots the angles of residue n with their change points to n_.png in directory"
+        import matplotlib.pyplot as plt # Plotting is optional
+        if n not in self.change_points:
+            self.change_points[n] = self.detect(n)[1]
+        angles, result = self.phi_psi_for_n(n), self.change_points[n]
         fig, a = rpt.display(angles,result)
         phi_ax, psi_ax = a
         phi, psi = angles.iloc[:,0], angles.iloc[:,1]
@@ -65,28 +128,39 @@ class RupturePlots:
         phi_ax.set_ylim([min_phi,max_phi])
         psi_ax.set_ylim([min_psi,max_psi])
         #phi_psi = ('\u03c6','\u03c8')[i%2]
-        phi_ax.set_title(num_to_res_n(n) + ' \u03c6', pad=-10,loc="left")
-        psi_ax.set_title(num_to_res_n(n) + ' \u03c8', pad=-10,loc="left")
-        fig.savefig('%d_.png' %n)
+        phi_ax.set_title(self.residue_name(n) + ' \u03c6', pad=-10,loc="left")
+        psi_ax.set_title(self.residue_name(n) + ' \u03c8', pad=-10,loc="left")
+        fig.savefig(os.path.join(directory,'%d_.png' %n))
+        plt.close(fig)
     
-    def make_figures(self):
-        for n in range(2,1397):
-            self.save_png(n)
+    def make_figures(self,plot=True,directory='.'):
+        "Detects the change points of all residues and plots them to directory if plot"
+        self.compute_change_points()
+        if plot:
+            for n in self.residues:
+                self.save_png(n,directory)
 
-def do_ruptures(traj_id):
-    #u = Universe(topology,trajectory)
-    os.chdir(traj_id)
+def do_ruptures(traj_id, workers=1, plot=True, mode='legacy'):
+    """Change points of the Ramachandran angles of the trajectory in the directory
+    traj_id, from rama_all_spiked.pkl (older versions) or the AngleStore rama_all.json,
+    with the spikes removed (see RupturePlots.remove_spikes for mode).
+    Saves them to change_points_.pkl and the figures to ruptures/.
+    All paths are explicit, so the working directory is never changed.
+    """
     print('Starting ruptures in %s' %traj_id)
-    rup = RupturePlots('rama_all_spiked.pkl')
-    rup.remove_spikes()
-    os.system('mv rama_all_no_spikes.pkl rama_all.pkl')
-    rup = RupturePlots('rama_all.pkl')
-    if not os.path.exists('ruptures'):
-        os.mkdir('ruptures')
-    os.chdir('ruptures')
-    rup.make_figures()
-    os.chdir('..')
-    pickle.dump(rup.change_points, open('change_points_.pkl','wb'))
+    spiked = os.path.join(traj_id,'rama_all_spiked.pkl')
+    if os.path.exists(spiked):
+        no_spikes, rama_all = os.path.join(traj_id,'rama_all_no_spikes.pkl'), os.path.join(traj_id,'rama_all.pkl')
+        RupturePlots(spiked).remove_spikes(no_spikes,mode)
+        os.replace(no_spikes,rama_all)
+    else: # Unwrapped chunk by chunk into a store of its own, rama_all.json stays as it is
+        rama_all = os.path.join(traj_id,'rama_all_no_spikes.json')
+        RupturePlots(os.path.join(traj_id,'rama_all.json')).remove_spikes(rama_all,mode)
+    rup = RupturePlots(rama_all,workers=workers)
+    figures = os.path.join(traj_id,'ruptures')
+    if plot and not os.path.exists(figures):
+        os.mkdir(figures)
+    rup.make_figures(plot,figures)
+    pickle.dump(rup.change_points, open(os.path.join(traj_id,'change_points_.pkl'),'wb'))
     print('Finished ruptures in %s' %traj_id)
-    os.chdir(TOPDIR)
-    del rup
+    return rup.change_points
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Local viewer which makes the MDavocado diagrams on request.
+
+Instead of writing a PNG for every residue in every slice (and the gifs and
+montages made from them), the server keeps only the histograms: the
+HistogramCube saved by a run (rama_cube.npz, janin_cube.npz) or, if there is
+none, the cube binned once from the saved angles (rama_all.json,
+janin_all.json). A diagram is shaded when it is asked for, and the encoded
+images are kept in a bounded LRU cache, so the diagrams looked at again are
+served from memory.
+
+    ./server.py directory [--port 8000] [--n 10] [--cache 256]
+
+and open http://localhost:8000/ in a browser. The images are at
+
+    /rama/residue/<n>.png?slice=i      diagram of residue n in slice i
+    /rama/residue/<n>.gif              all slices of residue n
+    /rama/montage/<chain>.png?slice=i  all residues of a chain in slice i
+    /rama/montage/<chain>.gif          all slices of a chain
+
+(janin/ instead of rama/ for the Janin diagrams), with &aggregate=1 for all
+frames from the start of the trajectory up to the end of the slice. Residues
+are given by their serial number n among all residues, as in the names of the
+images of a run (e.g. df0/12.png).
+"""
+import os
+import io
+import sys
+import json
+import argparse
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import datashader as ds
+from PIL import Image
+from datashader.colors import viridis
+from anglestore import AngleStore, store_paths
+from histograms import HistogramEngine, HistogramCube
+from images import annotate, montage, save_gif
+from residues import store_residues, store_serials
+
+# Canvas of the diagrams of each kind of angles, as in RamachandranPlots and JaninPlots
+CANVAS = {'rama': ((-180,180), (-180,180), ('Phi','Psi')),
+          'janin': ((0,360), (0,360), ('Chi1','Chi2'))}
+
+def slice_edges(nframes, n):
+    "Frame numbers cutting nframes frames into n slices, as RamachandranPlots.slices"
+    edges = list(range(0, nframes, nframes//n))
+    if nframes % n: edges[-1] = nframes
+    else: edges += [nframes]
+    return edges
+
+class ImageCache:
+    """
+    Encoded images by key, the least recently used ones dropped
+    once they take more than size bytes. Shared by the server threads.
+    """
+
+    def __init__(self, size=256*2**20):
+        self.size = size
+        self.images = OrderedDict()
+        self.bytes = 0
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, make):
+        "The image of key, made by make() (which returns the encoded bytes) if it is not cached"
+        with self.lock:
+            if key in self.images:
+                self.hits += 1
+                self.images.move_to_end(key)
+                return self.images[key]
+            self.misses += 1
+        data = make() # Outside the lock, so other images are served meanwhile
+        with self.lock:
+            if key not in self.images and len(data) <= self.size:
+                self.images[key] = data
+                self.bytes += len(data)
+                while self.bytes > self.size:
+                    self.bytes -= len(self.images.popitem(last=False)[1])
+        return data
+
+    def stats(self):
+        with self.lock:
+            return {'images': len(self.images), 'bytes': self.bytes, 'size': self.size,
+                    'hits': self.hits, 'misses': self.misses}
+
+class Diagrams:
+    """
+    The diagrams of one kind ('rama' or 'janin') of the run in directory,
+    from its saved histograms or binned from its saved angles into n slices.
+    """
+
+    def __init__(self, directory, kind, n=10, cmap=viridis):
+        self.kind, self.cmap = kind, cmap
+        cube_path = os.path.join(directory, '%s_cube.npz' % kind)
+        header_path = store_paths(os.path.join(directory, '%s_all' % kind))[0]
+        self.residues = None # (chain, label) of every residue, from the header of the store
+        if os.path.exists(header_path):
+            with open(header_path) as f:
+                header = json.load(f)
+            self.residues, self.serials = store_residues(header), store_serials(header)
+        if os.path.exists(cube_path):
+            self.cube = HistogramCube.load(cube_path)
+        elif self.residues is not None:
+            self.cube = self.bin_store(header_path, n)
+        else:
+            raise FileNotFoundError("Neither %s nor %s" % (cube_path, header_path))
+        if self.residues is None or len(self.residues) != self.cube.nresidues:
+            self.serials = list(range(1, self.cube.nresidues + 1))
+            self.residues = [('A', str(n)) for n in self.serials]
+        self.rows = {n: r for r, n in enumerate(self.serials)} # Serial number n -> index in the cube
+        self.chains = OrderedDict() # Chain -> indices of its residues
+        for r, (chain, label) in enumerate(self.residues):
+            self.chains.setdefault(chain, []).append(r)
+
+    def bin_store(self, path, n, chunk=10000):
+        "Histograms of the angles in the AngleStore at path, cut into n slices, binned chunk frames at a time"
+        store = AngleStore(path)
+        x_range, y_range, dims = CANVAS[self.kind]
+        engine = HistogramEngine(x_range, y_range, 500, 500, dims)
+        frames = slice_edges(store.shape[0], n)
+        cube = HistogramCube.for_engine(engine, frames, store.shape[1]//2)
+        print('Binning %s into %d slices' % (path, n))
+        for i in range(len(frames)-1):
+            counts = None
+            for start in range(frames[i], frames[i+1], chunk):
+                angles = store.array[start:min(start+chunk, frames[i+1])]
+                counts = engine.counts(angles[:,0::2], angles[:,1::2], counts)
+            cube.add(i, counts if counts is not None else engine.empty(cube.nresidues))
+        return cube
+
+    @property
+    def nslices(self):
+        return len(self.cube.frames) - 1
+
+    def label(self, r):
+        "Residue name, chain and number in the chain e.g. PHE A 221, as in the images of the run"
+        return self.residues[r][1]
+
+    def shade(self, counts, r):
+        "Labelled diagram (PIL image) of the counts of residue r"
+        img = ds.tf.shade(self.cube.engine.aggregate(counts), cmap=self.cmap).to_pil()
+        return annotate(img, self.label(r))
+
+    def image(self, r, i, aggregate=False):
+        "Labelled diagram of residue r in slice i"
+        return self.shade(self.cube.residue(i, r, aggregate), r)
+
+    def images(self, r, aggregate=False):
+        "Labelled diagrams of residue r in all slices, reading every slice once even if aggregate"
+        return [self.shade(counts, r) for i, counts in self.cube.residue_slices(r, cumulative=aggregate)]
+
+    def tile(self, chain, i, aggregate=False):
+        "Montage of all residues of chain in slice i, labelled with the chain"
+        tiles = [self.image(r, i, aggregate) for r in self.chains[chain]]
+        return annotate(montage(tiles), chain, pointsize=70, gravity='SouthEast')
+
+    def tiles(self, chain, aggregate=False, tile=100):
+        """Montages of all residues of chain in all slices, made residue by residue
+        so every slice of a residue is read once; only the thumbnails are kept
+        """
+        thumbs = [[] for i in range(self.nslices)]
+        for r in self.chains[chain]:
+            for i, img in enumerate(self.images(r, aggregate)):
+                thumbs[i].append(img.resize((tile, tile), Image.LANCZOS))
+        return [annotate(montage(t, tile), chain, pointsize=70, gravity='SouthEast') for t in thumbs]
+
+def encode(img, format='PNG'):
+    buffer = io.BytesIO()
+    img.save(buffer, format=format)
+    return buffer.getvalue()
+
+def encode_gif(frames):
+    buffer = io.BytesIO()
+    save_gif(frames, buffer)
+    return buffer.getvalue()
+
+class Handler(BaseHTTPRequestHandler):
+    diagrams = {} # Kind -> Diagrams, set by serve
+    cache = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = [p for p in url.path.split('/') if p]
+        try:
+            if not parts:
+                return self.send(self.index().encode(), 'text/html; charset=utf-8')
+            if parts == ['stats']:
+                return self.send(json.dumps(self.cache.stats()).encode(), 'application/json')
+            kind, what, name = parts
+            d = self.diagrams[kind]
+            stem, ext = os.path.splitext(name)
+            aggregate = query.get('aggregate', ['0'])[0] not in ('0', '')
+            i = int(query.get('slice', ['0'])[0])
+            if ext == '.png' and not 0 <= i < d.nslices:
+                raise KeyError(i)
+            key = (kind, what, stem, ext, aggregate, i if ext == '.png' else None)
+            if what == 'residue':
+                r = d.rows[int(stem)]
+                make = {'.png': lambda: encode(d.image(r, i, aggregate)),
+                        '.gif': lambda: encode_gif(d.images(r, aggregate))}[ext]
+            elif what == 'montage':
+                if stem not in d.chains:
+                    raise KeyError(stem)
+                make = {'.png': lambda: encode(d.tile(stem, i, aggregate)),
+                        '.gif': lambda: encode_gif(d.tiles(stem, aggregate))}[ext]
+            else:
+                raise KeyError(what)
+        except (KeyError, ValueError):
+            return self.send_error(404)
+        self.send(self.cache.get(key, make), 'image/' + ext[1:])
+
+    def send(self, data, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def index(self):
+        "Page with links to the gifs of all chains and residues"
+        html = ['<!DOCTYPE html><html><head><meta charset="UTF-8"><title>MDavocado</title></head><body>']
+        for kind, d in self.diagrams.items():
+            html.append('<h1>%s (%d slices)</h1>' % ({'rama': 'Ramachandran', 'janin': 'Janin'}[kind], d.nslices))
+            for chain, residues in d.chains.items():
+                html.append('<h2><a href="/%s/montage/%s.gif">Chain %s</a></h2><p>' % (kind, chain, chain))
+                html += ['<a href="/%s/residue/%d.gif">%s</a> ' % (kind, d.serials[r], d.label(r)) for r in residues]
+                html.append('</p>')
+        html.append('</body></html>')
+        return '\n'.join(html)
+
+    def log_message(self, format, *args):
+        pass # Quiet, the images are asked for many at a time
+
+def serve(directory, port=8000, n=10, cache=256*2**20, host='localhost'):
+    "Serves the diagrams of the run in directory until interrupted"
+    diagrams = {}
+    for kind in CANVAS:
+        try:
+            diagrams[kind] = Diagrams(directory, kind, n)
+        except FileNotFoundError:
+            pass
+    if not diagrams:
+        sys.exit("No histograms or angles of a run in %s" % directory)
+    Handler.diagrams, Handler.cache = diagrams, ImageCache(cache)
+    server = ThreadingHTTPServer((host, port), Handler)
+    print('Serving %s on http://%s:%d/' % (', '.join(diagrams), host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Makes the MDavocado diagrams of a run on request')
+    parser.add_argument('directory', help='Output directory of the run')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--n', type=int, default=10, help='Number of slices when binning the saved angles')
+    parser.add_argument('--cache', type=int, default=256, help='Size of the image cache in MB')
+    args = parser.parse_args()
+    serve(args.directory, args.port, args.n, args.cache*2**20, args.host)